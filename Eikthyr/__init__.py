@@ -1,44 +1,98 @@
 # -*- coding: utf-8 -*-
 
-# Load dotenv before everything
-from dotenv import load_dotenv as _load_dotenv, find_dotenv as _find_dotenv
-_load_dotenv(_find_dotenv(usecwd=True), override=True)
-
-# Deal with luigi's annoying deprecation warning
+# Everything below is only imported when first used, so that a script needing just
+# Path or cmdfmt doesn't pay for luigi and the rest
+import sys as _sys
+import types as _types
 import warnings as _warnings
-with _warnings.catch_warnings():
-    _warnings.simplefilter("ignore")
-    import luigi as lg
+from importlib import import_module as _import_module
 
-from . import param
-from .param import PathParameter, WhateverParameter, TaskParameter, TaskListParameter
-from luigi import Parameter, BoolParameter, IntParameter, FloatParameter, ListParameter, DictParameter
+# Disable annoying config and deprecation warnings from luigi, whichever module imports it first
+_warnings.filterwarnings("ignore", message="The configuration contains the parameter")
+_warnings.filterwarnings("ignore", message=r"\s*Autoloading range tasks", category=DeprecationWarning)
 
-from . import target
-from .target import Target, BinaryTarget
+# Convenient shortcuts from core python
+from pathlib import Path
+import shutil as sh
 
-from . import cmd
-from .cmd import chdir, mkcd, withEnv, cmdfmt, getenv
+_isEnvLoaded = False
 
-from . import task
-from .task import BaseTask, Task
-from .specialtask import InputTask
+def loadEnv(path=None, override=True):
+    """
+    Load the environment variables from a .env file, by default the nearest one from the current directory upwards.
+    This is done automatically before the first use of anything from this package, and at the start of run().
+    """
+    global _isEnvLoaded
+    _isEnvLoaded = True
+    from dotenv import load_dotenv, find_dotenv
+    return load_dotenv(path or find_dotenv(usecwd=True), override=override)
 
-from . import envcheck
-from .envcheck import EnvCheck
+def _ensureEnv():
+    if not _isEnvLoaded:
+        loadEnv()
 
-from . import logging
-from .logging import logger
+class _EnvHook(object):
+    # Also load .env before a submodule is imported directly, e.g. `import Eikthyr.task`, as luigi reads the environment on import
+    @staticmethod
+    def find_spec(name, path, target=None):
+        if name.startswith(__name__ + '.'):
+            _ensureEnv()
+        return None # Leave the actual import to the other finders
 
-from . import run
-from .run import run
+_sys.meta_path.insert(0, _EnvHook)
 
-from luigi import Config
+# Public name -> (module, dotted attribute), or the module itself if attribute is None
+_mLazy = {}
+for _module, _aNames in (
+        ('.param', ('PathParameter', 'WhateverParameter', 'TaskParameter', 'TaskListParameter')),
+        ('luigi', ('Parameter', 'BoolParameter', 'IntParameter', 'FloatParameter', 'ListParameter', 'DictParameter', 'Config')),
+        ('.target', ('Target', 'BinaryTarget', 'PipeTarget', 'CompressedTarget')),
+        ('.cmd', ('chdir', 'mkcd', 'withEnv', 'cmdfmt', 'getenv', 'CmdPool')),
+        ('.task', ('BaseTask', 'Task')),
+        ('.specialtask', ('InputTask',)),
+        ('.shard', ('ShardTask',)),
+        ('.envcheck', ('EnvCheck',)),
+        ('.logging', ('logger',)),
+        ('.run', ('run',)),
+        ('.plan', ('plan',)),
+        ('.watch', ('watch',)),
+        ('plumbum', ('local',)),
+        ):
+    _mLazy.update((_name, (_module, _name)) for _name in _aNames)
+for _name in ('param', 'target', 'task', 'envcheck', 'logging', 'cache', 'state', 'digest', 'trace', 'outputcache'):
+    _mLazy[_name] = ('.' + _name, None)
+_setInternal = {'cache', 'state', 'digest', 'trace', 'outputcache'}
+_mLazy['lg'] = ('luigi', None)
+# Convenient shortcut from plumbum
+_mLazy['cmd'] = ('plumbum', 'local.cmd')
+del _module, _aNames, _name
 
-# Convenient shortcuts from plumbum
-from plumbum import local
-cmd = local.cmd
+# Submodules named the same as the functions exposed here
+_setShadowed = {'run', 'plan', 'watch', 'cmd'}
 
-# Convenient shortcuts from core python
-from pathlib import Path
-import shutil as sh
+# Only the API, not the internal modules, which are still reachable as attributes
+__all__ = sorted(set(_mLazy) - _setInternal | {'Path', 'sh', 'loadEnv'})
+
+def __getattr__(name):
+    if name not in _mLazy:
+        raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+    _ensureEnv()
+    module, attr = _mLazy[name]
+    obj = _import_module(module, __name__)
+    if attr is not None:
+        for a in attr.split('.'):
+            obj = getattr(obj, a)
+    globals()[name] = obj
+    return obj
+
+def __dir__():
+    return sorted(set(globals()) | set(_mLazy))
+
+class _Package(_types.ModuleType):
+    def __setattr__(self, name, value):
+        # Importing a submodule sets it here, which must not hide the function of the same name
+        if name in _setShadowed and isinstance(value, _types.ModuleType) and value.__name__ == '{}.{}'.format(__name__, name):
+            return
+        super().__setattr__(name, value)
+
+_sys.modules[__name__].__class__ = _Package
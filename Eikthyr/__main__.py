@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2023, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import json
+import argparse
+import importlib
+from datetime import datetime
+
+import luigi as lg
+
+from . import buildstate
+from .plan import plan, formatPlan
+
+def cmdStateList(args):
+    for taskId, t in buildstate.getRecords(args.pattern):
+        print('{}\t{}'.format(datetime.fromtimestamp(t).isoformat(timespec='seconds'), taskId))
+
+def cmdStateShow(args):
+    rec = buildstate.getRecord(args.task)
+    if rec is None:
+        print("Task '{}' is not recorded".format(args.task), file=sys.stderr)
+        return 1
+    print(json.dumps(rec, indent=2, sort_keys=True))
+
+def cmdStateInvalidate(args):
+    print('Invalidated {} tasks'.format(buildstate.invalidate(args.pattern)))
+
+# Find the tasks from "module:name", where the name is a task, a list of tasks, or a function returning them
+def loadTasks(spec):
+    nameModule, _, nameAttr = spec.partition(':')
+    if '' not in sys.path:
+        sys.path.insert(0, '')
+    obj = getattr(importlib.import_module(nameModule), nameAttr or 'main')
+    if callable(obj) and not isinstance(obj, lg.Task):
+        obj = obj()
+    return [obj] if isinstance(obj, lg.Task) else list(obj)
+
+def cmdPlan(args):
+    aPlan = plan(loadTasks(args.tasks), check_digest=args.digest or None, build_state=args.build_state)
+    sys.stdout.write(formatPlan(aPlan, 'json' if args.json else 'text'))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m Eikthyr')
+    subparsers = parser.add_subparsers(required=True)
+
+    parserState = subparsers.add_parser('state', help='Inspect the build state database in the work directory')
+    subparsersState = parserState.add_subparsers(required=True)
+    p = subparsersState.add_parser('list', help='List recorded tasks')
+    p.add_argument('pattern', nargs='?', default='*', help='Glob pattern of task ids')
+    p.set_defaults(func=cmdStateList)
+    p = subparsersState.add_parser('show', help='Show the record of a task')
+    p.add_argument('task', help='Task id')
+    p.set_defaults(func=cmdStateShow)
+    p = subparsersState.add_parser('invalidate', help='Forget recorded tasks, so they are checked again next time')
+    p.add_argument('pattern', help='Glob pattern of task ids')
+    p.set_defaults(func=cmdStateInvalidate)
+
+    p = subparsers.add_parser('plan', help='List the tasks which would run, and why, without running anything')
+    p.add_argument('tasks', help='Where to find the tasks, as module:name, where the name is a task, a list of tasks, or a function returning them')
+    p.add_argument('--json', action='store_true', help='Output JSON lines instead of tab-separated text')
+    p.add_argument('--digest', action='store_true', help='Compare inputs by content digests')
+    p.add_argument('--build-state', action='store_true', help='Use the build state database')
+    p.set_defaults(func=cmdPlan)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
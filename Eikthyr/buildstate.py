@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2023, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+from fnmatch import fnmatchcase
+
+from . import cache
+from .state import db
+from .target import statCache
+
+# What each complete task looked like: the stat signatures of its outputs and direct inputs,
+# and the ids of the tasks it depends on
+db.addSchema('''CREATE TABLE IF NOT EXISTS buildstate (
+    task TEXT PRIMARY KEY, outputs TEXT, inputs TEXT, deps TEXT, time REAL)''')
+
+# Only used when switched on by run(build_state=True)
+enabled = False
+
+cacheRecorded = cache.BuildCache('Build state', volatile=True)
+
+def getSignatures(aPaths):
+    rslt = {}
+    for p in aPaths:
+        st = statCache.stat(p)
+        rslt[os.path.abspath(p)] = None if st is None else [st.st_size, st.st_mtime_ns]
+    return rslt
+
+def isMatching(mSig):
+    return getSignatures(mSig.keys()) == mSig
+
+def record(task, aOutputs, aInputs, aDeps):
+    if not enabled: return
+    db.write('INSERT OR REPLACE INTO buildstate VALUES (?, ?, ?, ?, ?)', task.task_id,
+            json.dumps(getSignatures([o.path for o in aOutputs if hasattr(o, 'path')])),
+            json.dumps(getSignatures([i.path for i in aInputs if hasattr(i, 'path')])),
+            json.dumps([d.task_id for d in aDeps]), time.time())
+
+def isComplete(task):
+    """
+    Return `True` if the task, and all tasks it depends on, are recorded complete and
+    none of their files has changed since. Only the database is consulted, so requires()
+    of the tasks is never called.
+    """
+    if not enabled: return False
+    memo = cacheRecorded.memo()
+    if task.task_id in memo:
+        cacheRecorded.hits += 1
+        return memo[task.task_id]
+    cacheRecorded.misses += 1
+
+    # Post-order walk through the recorded dependencies
+    mDeps = {}
+    aStack = [task.task_id]
+    while len(aStack) > 0:
+        taskId = aStack[-1]
+        if taskId in memo:
+            aStack.pop()
+            continue
+        if taskId not in mDeps:
+            row = db.execute('SELECT outputs, inputs, deps FROM buildstate WHERE task=?', taskId).fetchone()
+            if row is None or not isMatching(json.loads(row[0])) or not isMatching(json.loads(row[1])):
+                memo[taskId] = False
+                aStack.pop()
+                continue
+            mDeps[taskId] = json.loads(row[2])
+            aStack.extend(d for d in mDeps[taskId] if d not in memo)
+            continue
+        aStack.pop()
+        memo[taskId] = all(memo[d] for d in mDeps[taskId])
+    return memo[task.task_id]
+
+def getRecords(pattern='*'):
+    """Return (task_id, time) of all recorded tasks matching a glob pattern."""
+    return [(taskId, t) for taskId, t in db.execute('SELECT task, time FROM buildstate ORDER BY task')
+            if fnmatchcase(taskId, pattern)]
+
+def getRecord(taskId):
+    row = db.execute('SELECT outputs, inputs, deps, time FROM buildstate WHERE task=?', taskId).fetchone()
+    if row is None: return None
+    return {'outputs': json.loads(row[0]), 'inputs': json.loads(row[1]), 'deps': json.loads(row[2]), 'time': row[3]}
+
+def forget(task):
+    """Forget one task, e.g. when it has to run again for some reason not seen in its files."""
+    if not enabled: return
+    db.write('DELETE FROM buildstate WHERE task=?', task.task_id)
+    cacheRecorded.invalidate()
+
+def invalidate(pattern='*'):
+    """Forget all recorded tasks matching a glob pattern, and return how many there were."""
+    aTaskIds = [taskId for taskId, _ in getRecords(pattern)]
+    db.executemany('DELETE FROM buildstate WHERE task=?', [(taskId,) for taskId in aTaskIds])
+    cacheRecorded.invalidate()
+    return len(aTaskIds)
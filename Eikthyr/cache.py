@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2023, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from contextlib import contextmanager
+
+# All caches ever created, so that a build can switch them on and off together
+aCaches = []
+
+class BuildCache(object):
+    """A memo which only remembers things during a build, i.e. inside Eikthyr.run().
+
+    Outside of a build, every lookup is computed afresh, so that changes made to the
+    filesystem between two builds are always seen.
+    A volatile cache holds things derived from the filesystem, and is dropped whenever
+    a task starts running, because the task may change the files.
+    """
+
+    def __init__(self, name, volatile=False):
+        self.name = name
+        self.volatile = volatile
+        self.enabled = True
+        self.active = False
+        self.data = {}
+        self.kept = None
+        self.hits = 0
+        self.misses = 0
+        aCaches.append(self)
+
+    def __contains__(self, key):
+        return self.active and key in self.data
+
+    def memo(self):
+        """The dictionary to memoize into: the shared one during a build, or a throwaway one otherwise."""
+        if self.active:
+            return self.data
+        return {}
+
+    def get(self, key, fnCompute):
+        if not self.active:
+            return fnCompute()
+        try:
+            val = self.data[key]
+            self.hits += 1
+            return val
+        except KeyError:
+            self.misses += 1
+            val = fnCompute()
+            self.data[key] = val
+            return val
+
+    def put(self, key, val):
+        if self.active:
+            self.data[key] = val
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.data.clear()
+        else:
+            self.data.pop(key, None)
+
+    def reset(self):
+        self.data.clear()
+        if self.kept is not None:
+            self.data.update(self.kept)
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return '{}: {} hits, {} misses'.format(self.name, self.hits, self.misses)
+
+@contextmanager
+def scope():
+    """Activate all enabled caches for the duration of one build."""
+    for c in aCaches:
+        c.reset()
+        c.active = c.enabled
+    try:
+        yield
+    finally:
+        for c in aCaches:
+            c.active = False
+            c.data.clear()
+
+@contextmanager
+def keep(c, data):
+    """Start every build within the context with the specified content in a cache, e.g. across the rounds of watch()."""
+    keptOld = c.kept
+    c.kept = data
+    try:
+        yield
+    finally:
+        c.kept = keptOld
+
+def invalidateVolatile(exclude=()):
+    for c in aCaches:
+        if c.volatile and c not in exclude:
+            c.invalidate()
+
+def summary():
+    return '; '.join(repr(c) for c in aCaches if c.enabled)
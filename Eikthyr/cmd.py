@@ -14,10 +14,17 @@
 # limitations under the License.
 
 import os
+import gzip
+import time
+import threading
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from pathlib import Path
 from plumbum import local
+from plumbum.commands import ProcessExecutionError
 
+from . import trace
 from .logging import logger
 
 # Change directory within a context
@@ -60,3 +67,184 @@ def getenv(*args, **kwargs):
 def cmdfmt(lst, *args, **kwargs):
     lst = [s.format(*args, **kwargs) for s in lst]
     return local[lst[0]][lst[1:]]
+
+class OutputCapture(object):
+    """Stream the stdout and stderr of commands into a log file, instead of the terminal.
+
+    Only the last `nTail` lines are kept in memory, to be shown if a command fails.
+    If `intervalLive` is set, the latest line is also logged, at most once per that many seconds.
+    Several commands may write into the same capture at once; their lines are never mixed up.
+    The log file is open while within the context of this object.
+    """
+
+    SIZE_LINE_MAX = 1 << 16
+
+    def __init__(self, path, compress=False, nTail=20, intervalLive=None, prefix='', logger=logger):
+        self.path = Path(path)
+        self.compress = compress
+        self.aTail = deque(maxlen=nTail)
+        self.intervalLive = intervalLive
+        self.prefix = prefix
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.tLive = 0.0
+
+    def popen(self, chain, **kwargs):
+        """Start a command with its output captured, and return the process and the thread reading from it."""
+        fdRead, fdWrite = os.pipe()
+        try:
+            proc = chain.popen(stdin=None, stdout=fdWrite, stderr=fdWrite, **kwargs)
+        except BaseException:
+            os.close(fdRead)
+            raise
+        finally:
+            os.close(fdWrite) # Only the children hold it now, so reading ends when they all exit
+        thread = threading.Thread(target=self.pump, args=(fdRead,), daemon=True)
+        thread.start()
+        return proc, thread
+
+    def run(self, chain, **kwargs):
+        proc, thread = self.popen(chain, **kwargs)
+        rtn = proc.wait()
+        thread.join()
+        return rtn
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fpLog = (gzip.open if self.compress else open)(self.path, 'ab')
+        return self
+
+    def __exit__(self, *args):
+        self.fpLog.close()
+
+    def pump(self, fdRead):
+        with os.fdopen(fdRead, 'rb') as fp:
+            while True:
+                line = fp.readline(self.SIZE_LINE_MAX)
+                if not line: break
+                with self.lock:
+                    self.fpLog.write(line)
+                    self.aTail.append(line)
+                    if self.intervalLive is not None and time.time() - self.tLive >= self.intervalLive:
+                        self.tLive = time.time()
+                        self.logger.info("{}{}".format(self.prefix, line.decode(errors='replace').rstrip()))
+
+    def getTail(self):
+        with self.lock:
+            return b''.join(self.aTail).decode(errors='replace')
+
+# The outcome of one command run by CmdPool: returncode is None if it was cancelled before starting
+CmdResult = namedtuple('CmdResult', ('chain', 'returncode', 'time'))
+
+def reapWithUsage(proc):
+    """
+    Reap a process, and the ones piped into it, so that proc.wait() afterwards only collects the exit codes.
+    Return their total user and system CPU time, and the largest resident set size among them (in kB on Linux).
+    """
+    utime = stime = 0.0
+    maxrss = 0
+    while proc is not None:
+        popen = getattr(proc, '_proc', proc)
+        try:
+            _, status, usage = os.wait4(popen.pid, 0)
+        except ChildProcessError:
+            break # Already reaped, e.g. when terminated by cancel()
+        popen._handle_exitstatus(status)
+        utime += usage.ru_utime
+        stime += usage.ru_stime
+        maxrss = max(maxrss, usage.ru_maxrss)
+        proc = getattr(proc, 'srcproc', None)
+    return {'utime': utime, 'stime': stime, 'maxrss': maxrss}
+
+def runWithUsage(chain, capture=None):
+    """
+    Run a command to the terminal, or into an `OutputCapture` if specified, and return its exit code,
+    and its own resource usage by reapWithUsage(), or {} if that is not available.
+    """
+    if capture is None:
+        proc = chain.popen(stdin=None, stdout=None, stderr=None)
+        thread = None
+    else:
+        proc, thread = capture.popen(chain)
+    mUsage = reapWithUsage(proc) if hasattr(os, 'wait4') else {}
+    rtn = proc.wait()
+    if thread is not None:
+        thread.join()
+    return rtn, mUsage
+
+class CmdPool(object):
+    """Run many plumbum commands concurrently, with at most `jobs` of them at once.
+
+    Each command runs in the working directory and the environment in effect when it was added,
+    so `chdir` and `withEnv` can be applied per command. If `failFast` is set, the first failure
+    terminates the other running commands and cancels the ones not started yet.
+    The output goes to the terminal, or into an `OutputCapture` if specified.
+    When tracing, each command is recorded for `task`, with the CPU time and memory of its own processes.
+    """
+
+    def __init__(self, jobs=None, failFast=True, logger=logger, capture=None, task=None):
+        self.jobs = jobs or os.cpu_count() or 1
+        self.task = task
+        self.failFast = failFast
+        self.logger = logger
+        self.capture = capture
+        self.aCmds = []
+        self.aResults = []
+        self.lock = threading.Lock()
+        self.setRunning = set()
+        self.isCancelled = False
+        self.rsltFailed = None
+
+    def add(self, chain):
+        self.aCmds.append((chain, os.getcwd(), local.env.getdict()))
+
+    __call__ = add
+
+    def runOne(self, chain, cwd, env):
+        with self.lock:
+            if self.isCancelled:
+                return CmdResult(chain, None, 0.0)
+            self.logger.info("RUN: {}".format(chain))
+            t0 = time.time()
+            if self.capture is None:
+                proc = chain.popen(cwd=cwd, env=env, stdin=None, stdout=None, stderr=None)
+                thread = None
+            else:
+                proc, thread = self.capture.popen(chain, cwd=cwd, env=env)
+            self.setRunning.add(proc)
+        mUsage = {}
+        try:
+            if trace.enabled and hasattr(os, 'wait4'):
+                mUsage = reapWithUsage(proc)
+            rtn = proc.wait()
+            if thread is not None:
+                thread.join()
+        finally:
+            with self.lock:
+                self.setRunning.discard(proc)
+        rslt = CmdResult(chain, rtn, time.time() - t0)
+        trace.addEvent('ex', 'command', t0, t0 + rslt.time, cmd=str(chain), task=self.task, returncode=rtn, **mUsage)
+        if rtn != 0:
+            with self.lock:
+                if self.rsltFailed is None:
+                    self.rsltFailed = rslt
+            if self.failFast:
+                self.cancel()
+        return rslt
+
+    def cancel(self):
+        with self.lock:
+            self.isCancelled = True
+            for proc in self.setRunning:
+                proc.terminate()
+
+    def run(self):
+        """Run all commands added, and raise ProcessExecutionError for the first failed one."""
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            self.aResults = list(pool.map(lambda cmd: self.runOne(*cmd), self.aCmds))
+        for rslt in self.aResults:
+            self.logger.debug("Command exited with {} in {:.1f}s: {}".format(rslt.returncode, rslt.time, rslt.chain))
+        if self.rsltFailed is not None:
+            tail = '' if self.capture is None else self.capture.getTail()
+            raise ProcessExecutionError(self.rsltFailed.chain.formulate(), self.rsltFailed.returncode, tail, '')
+        return self.aResults
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2023, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+
+from . import cache
+from .state import db
+
+# The on-disk index: a file is only hashed again when its (device, inode, size, mtime) changes
+db.addSchema('''CREATE TABLE IF NOT EXISTS digest (
+    dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER, digest TEXT,
+    PRIMARY KEY (dev, ino, size, mtime))''')
+
+# The digests of the inputs of a task at the time its outputs were built
+db.addSchema('''CREATE TABLE IF NOT EXISTS inputdigest (
+    task TEXT PRIMARY KEY, outputs TEXT, inputs TEXT)''')
+
+cacheDigest = cache.BuildCache('Digest', volatile=True)
+
+SIZE_CHUNK = 1 << 20
+
+def hashFile(path):
+    h = md5()
+    with open(path, 'rb') as fp:
+        while True:
+            buf = fp.read(SIZE_CHUNK)
+            if not buf: break
+            h.update(buf)
+    return h.hexdigest()
+
+def getSignature(st):
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+def digestFiles(aPaths, nThreads=8):
+    """Return the digests of a list of regular files, hashing in parallel only those not found in the index."""
+    aPathStats = [(p, os.stat(p)) for p in aPaths]
+    mDigest = {}
+    aMissing = []
+    for path, st in aPathStats:
+        row = db.execute('SELECT digest FROM digest WHERE dev=? AND ino=? AND size=? AND mtime=?', *getSignature(st)).fetchone()
+        if row is None:
+            aMissing.append((path, st))
+        else:
+            mDigest[path] = row[0]
+
+    if len(aMissing) > 0:
+        with ThreadPoolExecutor(max_workers=nThreads) as pool:
+            aDigests = list(pool.map(hashFile, (p for p, _ in aMissing)))
+        db.executemany('INSERT OR REPLACE INTO digest VALUES (?, ?, ?, ?, ?)',
+                [getSignature(st) + (d,) for (_, st), d in zip(aMissing, aDigests)])
+        mDigest.update((p, d) for (p, _), d in zip(aMissing, aDigests))
+    return mDigest
+
+def digestDir(path, nThreads=8):
+    """A directory is digested by the relative names and the digests of all files inside."""
+    aPaths = []
+    for dirCurrent, aDirs, aFiles in os.walk(path):
+        aDirs.sort()
+        aPaths.extend(os.path.join(dirCurrent, f) for f in sorted(aFiles))
+    mDigest = digestFiles(aPaths, nThreads)
+    h = md5()
+    for p in aPaths:
+        h.update('{}\0{}\n'.format(os.path.relpath(p, path), mDigest[p]).encode('UTF-8'))
+    return h.hexdigest()
+
+def digestMany(aPaths, nThreads=8):
+    """Return a dictionary from each path to its content digest."""
+    mDigest = {}
+    aFiles = []
+    for p in aPaths:
+        key = os.path.abspath(p)
+        if key in cacheDigest:
+            cacheDigest.hits += 1
+            mDigest[p] = cacheDigest.data[key]
+        elif os.path.isdir(p):
+            mDigest[p] = cacheDigest.get(key, lambda: digestDir(p, nThreads))
+        else:
+            aFiles.append(p)
+    if len(aFiles) > 0:
+        cacheDigest.misses += len(aFiles)
+        for p, d in digestFiles(aFiles, nThreads).items():
+            cacheDigest.put(os.path.abspath(p), d)
+            mDigest[p] = d
+    return mDigest
+
+def getOutputSignatures(aOutputs):
+    rslt = {}
+    for out in aOutputs:
+        if not hasattr(out, 'path'): continue
+        st = os.stat(out.path)
+        rslt[out.path] = [st.st_size, st.st_mtime_ns]
+    return rslt
+
+def record(task, aOutputs, mDigestInput):
+    db.write('INSERT OR REPLACE INTO inputdigest VALUES (?, ?, ?)', task.task_id,
+            json.dumps(getOutputSignatures(aOutputs), sort_keys=True), json.dumps(mDigestInput, sort_keys=True))
+
+def isUnchanged(task, aOutputs, aInputs, isNewer):
+    """
+    Decide the completeness of a task by the content of its inputs.
+
+    If the outputs are the same ones recorded last time, the task is complete exactly when
+    the input digests still match the recorded ones. Otherwise there is nothing to compare,
+    so the mtime result `isNewer` decides, and the current digests are recorded when it is complete.
+    """
+    aPaths = sorted({obj.path for obj in aInputs if hasattr(obj, 'path')})
+    row = db.execute('SELECT outputs, inputs FROM inputdigest WHERE task=?', task.task_id).fetchone()
+    if row is not None and json.loads(row[0]) == getOutputSignatures(aOutputs):
+        return json.loads(row[1]) == digestMany(aPaths)
+    if isNewer:
+        record(task, aOutputs, digestMany(aPaths))
+    return isNewer
@@ -13,16 +13,148 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import sys
+import json
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from shutil import which
 
 import luigi as lg
 from plumbum import local
 
+from .state import db, getStateDir
 from .logging import logger
 
+# The fingerprint of the tools each complete task was found with, and the signatures of its outputs then
+db.addSchema('''CREATE TABLE IF NOT EXISTS toolstate (
+    task TEXT PRIMARY KEY, fingerprint TEXT, outputs TEXT)''')
+
+# All declared environment checks
+aRegistry = []
+
+# (PATH, command) -> {'path', 'size', 'mtime', 'version'} of the current run, inherited by the forked workers
+mResolved = {}
+
+def getPath():
+    return local.env.get('PATH', '')
+
+def getFingerprintFile():
+    return getStateDir() / 'envcheck.json'
+
+def getCmdName(cmd):
+    if isinstance(cmd, (tuple, list, lg.ListParameter)):
+        return cmd[0] if len(cmd) > 0 else None
+    return cmd
+
+def probe(name, PATH, aVersionArgs, entryOld=None):
+    """Find a command on PATH, and run it with aVersionArgs for its version unless the binary is the same as in entryOld."""
+    path = which(name, path=PATH)
+    if path is None:
+        return {'path': None}
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    entry = {'path': path, 'size': st.st_size, 'mtime': st.st_mtime_ns, 'version': None}
+    if aVersionArgs is None:
+        return entry
+    if entryOld is not None and all(entryOld.get(k) == entry[k] for k in ('path', 'size', 'mtime')) and entryOld.get('version') is not None:
+        entry['version'] = entryOld['version']
+        return entry
+    try:
+        proc = subprocess.run([path] + list(aVersionArgs), stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=30)
+        entry['version'] = proc.stdout.decode('UTF-8', 'replace').strip().split('\n')[0]
+    except (OSError, subprocess.SubprocessError) as ex:
+        logger.warning("Cannot get the version of {}: {}".format(path, ex))
+    return entry
+
+def resolveAll(nThreads=16):
+    """
+    Find all commands of the declared environment checks on PATH at once, in parallel, and get the versions
+    of those asking for it. The results are kept in a fingerprint file keyed by PATH, so that the versions
+    are only probed again when the binaries change.
+
+    This starts afresh each time, so that binaries changed since the last call are noticed.
+    """
+    mResolved.clear()
+    PATH = getPath()
+    mVersionArgs = {}
+    for cls in aRegistry:
+        name = getCmdName(cls.cmd)
+        if name is None: continue
+        mVersionArgs.setdefault(name, None)
+        if cls.versionArgs is not None:
+            mVersionArgs[name] = cls.versionArgs
+    aNames = list(mVersionArgs)
+    if len(aNames) == 0:
+        return
+
+    pathFile = getFingerprintFile()
+    keyPath = md5(PATH.encode('UTF-8')).hexdigest()
+    try:
+        mFile = json.loads(pathFile.read_text())
+    except (OSError, ValueError):
+        mFile = {}
+    mOld = mFile.get(keyPath, {})
+    with ThreadPoolExecutor(max(nThreads, 1)) as pool:
+        aEntries = list(pool.map(lambda name: probe(name, PATH, mVersionArgs[name], mOld.get(name)), aNames))
+    for name, entry in zip(aNames, aEntries):
+        mResolved[(PATH, name)] = entry
+        mOld[name] = entry
+    mFile[keyPath] = mOld
+
+    try:
+        pathFile.parent.mkdir(parents=True, exist_ok=True)
+        pathTmp = pathFile.with_name('{}.{}'.format(pathFile.name, os.getpid()))
+        pathTmp.write_text(json.dumps(mFile, indent=1, sort_keys=True))
+        os.replace(pathTmp, pathFile)
+    except OSError as ex:
+        logger.warning("Cannot write {}: {}".format(pathFile, ex))
+
+def resolve(name, aVersionArgs=None):
+    PATH = getPath()
+    key = (PATH, name)
+    if key not in mResolved or (aVersionArgs is not None and mResolved[key].get('version') is None and mResolved[key]['path'] is not None):
+        mResolved[key] = probe(name, PATH, aVersionArgs)
+    return mResolved[key]
+
+def getFingerprint(aChecks):
+    """A digest of the binaries, and their versions, of the specified environment check classes."""
+    mEntries = {}
+    for cls in aChecks:
+        name = getCmdName(cls.cmd)
+        if name is None: continue
+        mEntries[name] = resolve(name, cls.versionArgs)
+    return md5(json.dumps(mEntries, sort_keys=True).encode('UTF-8')).hexdigest()
+
+def isToolChanged(task, mSigOutputs):
+    """
+    Return whether the tools of a complete task have changed since its outputs were made.
+    Tasks seen for the first time, or whose outputs were made again, take the current tools.
+    """
+    fingerprint = getFingerprint(task.envChecks)
+    sigOutputs = json.dumps(mSigOutputs, sort_keys=True)
+    row = db.execute('SELECT fingerprint, outputs FROM toolstate WHERE task=?', task.task_id).fetchone()
+    if row is not None and row[1] == sigOutputs:
+        return row[0] != fingerprint
+    db.write('INSERT OR REPLACE INTO toolstate VALUES (?, ?, ?)', task.task_id, fingerprint, sigOutputs)
+    return False
+
 class EnvCheck(object):
+    """
+    Check that a command is available, once per subclass. Set `cmd` to the command, and `versionArgs` to
+    the arguments printing its version, e.g. ('--version',), if tasks depending on it through their
+    `envChecks` should run again when the version changes. All subclasses are checked at once by run().
+    """
     _instance = None
     cmd = None
+    versionArgs = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._instance = None
+        aRegistry.append(cls)
 
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
@@ -32,12 +164,9 @@ class EnvCheck(object):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         if self.cmd != None:
-            if isinstance(self.cmd, tuple) or isinstance(self.cmd, list) or isinstance(self.cmd, lg.ListParameter):
-                if len(self.cmd)>0 and not self.cmd[0] in local:
-                    self.failCmd(self.cmd[0])
-            else:
-                if not self.cmd in local:
-                    self.failCmd(self.cmd)
+            name = getCmdName(self.cmd)
+            if name is not None and resolve(name)['path'] is None:
+                self.failCmd(name)
             self.cmd = None # So that the check only runs once
 
     def failCmd(self, cmd):
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2023, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import queue
+import threading
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from inspect import isgenerator
+
+import luigi as lg
+from luigi.task import flatten, getpaths
+
+from . import cache
+from . import outputcache
+from .task import resolver
+from .target import PipeTarget, setPiped, statCache
+from .logging import logger
+
+def isExternal(task):
+    return task.run is None or task.run == NotImplemented
+
+def runDynamic(task, gen):
+    """Run the dynamic dependencies yielded from run() right here, and send their outputs back."""
+    try:
+        req = next(gen)
+        while True:
+            aIncomplete = [d for d in flatten(req) if not d.complete()]
+            if len(aIncomplete) > 0:
+                rslt = LocalExecutor().build(aIncomplete)
+                if rslt.status != lg.LuigiStatusCode.SUCCESS:
+                    raise RuntimeError("Dynamic dependencies of {} failed".format(task))
+            req = gen.send(getpaths(req))
+    except StopIteration:
+        pass
+
+def runTask(task):
+    rtn = task.run()
+    if isgenerator(rtn):
+        runDynamic(task, rtn)
+
+def execute(task):
+    """Run one task in this process as luigi would, and return None, or the explanation of the failure."""
+    try:
+        task.trigger_event(lg.Event.START, task)
+        t0 = time.time()
+        if isExternal(task):
+            if not task.complete():
+                raise RuntimeError("Task is an external data dependency and data does not exist (yet?).")
+        else:
+            outputcache.runWithCache(task, lambda: runTask(task))
+            if not task.complete():
+                raise RuntimeError("Task finished running, but complete() is still returning false.")
+        task.trigger_event(lg.Event.PROCESSING_TIME, task, time.time() - t0)
+        task.on_success()
+        task.trigger_event(lg.Event.SUCCESS, task)
+        return None
+    except Exception as ex:
+        logger.error("Task {} failed:\n{}".format(task, traceback.format_exc()))
+        task.trigger_event(lg.Event.FAILURE, task, ex)
+        return task.on_failure(ex) or '{}: {}'.format(type(ex).__name__, ex)
+
+def drainPipe(path, evtDone):
+    """Read and discard whatever is left in a FIFO after its consumer is gone, so that the producer doesn't block forever."""
+    while not evtDone.is_set():
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        except FileNotFoundError:
+            return
+        try:
+            os.set_blocking(fd, True)
+            while len(os.read(fd, 1<<16)) > 0: pass
+        finally:
+            os.close(fd)
+        evtDone.wait(0.05)
+
+def executeInChild(task, conn):
+    conn.send((execute(task),))
+    conn.close()
+
+class LocalResult(object):
+    """Looks like the result of lg.build(detailed_summary=True), as far as run() cares."""
+
+    def __init__(self, worker, status, summary_text):
+        self.worker = worker
+        self.status = status
+        self.summary_text = summary_text
+
+class LocalExecutor(object):
+    """
+    Run a task graph directly, without the luigi scheduler and its polling.
+
+    The graph is walked once to find the incomplete tasks, and each task is dispatched
+    as soon as all its dependencies are done and its resources fit in the capacity.
+    Like luigi, with more than one worker each task runs in a forked process, unless
+    `useProcesses` is set to False, in which case the tasks run in threads.
+
+    A task producing PipeTargets is started together with its only consumer when possible,
+    and the data is streamed between them through FIFOs instead of files.
+    """
+
+    def __init__(self, workers=1, capacity=None, useProcesses=None):
+        self.workers = workers
+        self.capacity = capacity or {}
+        self.useProcesses = workers > 1 if useProcesses is None else useProcesses
+        self.aTimeline = []
+        self.qDone = queue.Queue()
+
+    def schedule(self, tasks):
+        """Return {task: incomplete dependencies} of all incomplete tasks under the specified ones, and the complete ones."""
+        mDeps = {}
+        setComplete = set()
+        aStack = list(tasks)
+        while len(aStack) > 0:
+            t = aStack.pop()
+            if t in mDeps or t in setComplete: continue
+            if t.complete():
+                setComplete.add(t)
+                continue
+            mDeps[t] = resolver.node(t)[1]
+            aStack.extend(mDeps[t])
+        return {t: [d for d in aDeps if d in mDeps] for t, aDeps in mDeps.items()}, setComplete
+
+    def isFitting(self, task, used):
+        return all(used[name] + amount <= self.capacity.get(name, 1)
+                for name, amount in (task.process_resources() or {}).items())
+
+    def getPipeConsumer(self, task, mDependents, mWaiting, used, nRunning):
+        """
+        Return the consumer to run together with the task to start, if the task produces PipeTargets,
+        and its only consumer is waiting for nothing else, and both can run now.
+        """
+        if not any(isinstance(out, PipeTarget) for out in flatten(task.output())): return None
+        if len(mDependents[task]) != 1 or nRunning + 2 > self.workers: return None
+        consumer = mDependents[task][0]
+        if mWaiting[consumer] != 1 or not self.isFitting(consumer, used): return None
+        return consumer
+
+    def openPipes(self, task):
+        aPipes = []
+        tStart = time.time()
+        for out in flatten(task.output()):
+            if not isinstance(out, PipeTarget): continue
+            out.makedirs()
+            if os.path.lexists(out.path):
+                os.unlink(out.path)
+            out.forgetStreamed()
+            os.mkfifo(out.path)
+            # By the clock of the filesystem, to be compared with the output of the consumer
+            tStart = min(tStart, os.stat(out.path).st_mtime)
+            setPiped.add(os.path.abspath(out.path))
+            aPipes.append((out, threading.Event()))
+        return aPipes, tStart
+
+    def closePipes(self, aPipes, tStart, isSuccess):
+        for out, evtDone in aPipes:
+            evtDone.set()
+            setPiped.discard(os.path.abspath(out.path))
+            os.unlink(out.path)
+            statCache.forget(out.path)
+            # The data is gone, but remember it was made, as of when it started streaming
+            if isSuccess:
+                out.markStreamed(tStart)
+
+    def start(self, task, pool):
+        if pool is not None:
+            pool.submit(lambda: self.qDone.put((task, execute(task))))
+            return
+        if not self.useProcesses:
+            self.qDone.put((task, execute(task)))
+            return
+        connRecv, connSend = multiprocessing.Pipe(duplex=False)
+        proc = multiprocessing.Process(target=executeInChild, args=(task, connSend))
+        proc.start()
+        connSend.close()
+        def waitChild():
+            wait([connRecv, proc.sentinel])
+            try:
+                expl, = connRecv.recv()
+                proc.join()
+            except EOFError:
+                proc.join()
+                expl = 'Process exited with code {} without finishing'.format(proc.exitcode)
+            self.qDone.put((task, expl))
+        threading.Thread(target=waitChild, daemon=True).start()
+
+    def build(self, tasks):
+        try:
+            mDeps, setComplete = self.schedule(tasks)
+        except Exception:
+            logger.error("Scheduling failed:\n{}".format(traceback.format_exc()))
+            return LocalResult(self, lg.LuigiStatusCode.SCHEDULING_FAILED, 'Scheduling failed')
+
+        mWaiting = {t: len(aDeps) for t, aDeps in mDeps.items()}
+        mDependents = {t: [] for t in mDeps}
+        for t, aDeps in mDeps.items():
+            for d in aDeps:
+                mDependents[d].append(t)
+        aReady = [t for t, n in mWaiting.items() if n == 0]
+        mStarted = {}
+        used = Counter()
+        aDone = []
+        aFailed = []
+        # Producers and consumers running together through pipes: task -> (producer, consumer, (pipes, start time))
+        mPair = {}
+        mHeld = {}
+
+        def finish(task, expl):
+            if expl is not None:
+                aFailed.append(task)
+                return
+            aDone.append(task)
+            for t in mDependents[task]:
+                mWaiting[t] -= 1
+                if mWaiting[t] == 0 and t not in mPair:
+                    aReady.append(t)
+
+        pool = ThreadPoolExecutor(self.workers) if self.workers > 1 and not self.useProcesses else None
+        try:
+            while len(aReady) > 0 or len(mStarted) > 0:
+                aReady.sort(key=lambda t: -t.priority)
+                for t in list(aReady):
+                    if len(mStarted) >= self.workers: break
+                    if not self.isFitting(t, used): continue
+                    aReady.remove(t)
+                    used.update(t.process_resources() or {})
+                    consumer = self.getPipeConsumer(t, mDependents, mWaiting, used, len(mStarted))
+                    if consumer is not None:
+                        used.update(consumer.process_resources() or {})
+                        mPair[t] = mPair[consumer] = (t, consumer, self.openPipes(t))
+                        mStarted[consumer] = time.time()
+                        self.start(consumer, pool)
+                    mStarted[t] = time.time()
+                    self.start(t, pool)
+                if len(mStarted) == 0:
+                    # Whatever is left can never fit
+                    for t in aReady:
+                        logger.error("{} needs more resources than available: {}".format(t, t.process_resources()))
+                    aFailed.extend(aReady)
+                    break
+
+                task, expl = self.qDone.get()
+                self.aTimeline.append((task, mStarted.pop(task), time.time()))
+                used.subtract(task.process_resources() or {})
+                # The finished task may have changed any file
+                cache.invalidateVolatile()
+                if task not in mPair:
+                    finish(task, expl)
+                    continue
+
+                # Both sides of a pipe have to be finished together
+                producer, consumer, (aPipes, tStart) = mPair[task]
+                partner = consumer if task is producer else producer
+                if partner in mStarted:
+                    mHeld[task] = expl
+                    if task is consumer:
+                        for out, evtDone in aPipes:
+                            threading.Thread(target=drainPipe, args=(out.path, evtDone), daemon=True).start()
+                    continue
+                explPartner = mHeld.pop(partner)
+                self.closePipes(aPipes, tStart, expl is None and explPartner is None)
+                if expl is not None or explPartner is not None:
+                    # The consumer may have got a truncated input
+                    for out in flatten(consumer.output()):
+                        if isinstance(out, lg.LocalTarget) and out.exists():
+                            out.remove()
+                    expl = expl or explPartner
+                finish(producer, expl)
+                finish(consumer, expl)
+                del mPair[producer], mPair[consumer]
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        nPending = len(mDeps) - len(aDone) - len(aFailed)
+        status = lg.LuigiStatusCode.SUCCESS if len(aFailed) == 0 and nPending == 0 else lg.LuigiStatusCode.FAILED
+        summary = 'Scheduled {} tasks of which: {} complete ones were encountered, {} ran successfully, {} failed, {} were left pending'.format(
+                len(mDeps) + len(setComplete), len(setComplete), len(aDone), len(aFailed), nPending)
+        return LocalResult(self, status, summary)
@@ -15,13 +15,3 @@
 
 from logzero import setup_logger
 logger = setup_logger('Eikthyr')
-
-# Disable annoying config warnings from luigi
-import warnings
-from luigi.parameter import UnconsumedParameterWarning
-warnings.simplefilter("ignore", UnconsumedParameterWarning)
-
-# Deal with luigi's annoying deprecation warning
-with warnings.catch_warnings():
-    warnings.simplefilter("ignore")
-    import luigi
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2023, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import errno
+import fcntl
+import shutil
+import tempfile
+import multiprocessing
+from contextlib import contextmanager
+from hashlib import md5
+from pathlib import Path
+
+from luigi.task import flatten
+
+from . import digest
+from .target import Target, PipeTarget
+from .task import resolver
+from .logging import logger
+
+# Only used within run(output_cache=...)
+root = None
+sizeMax = None
+
+# Shared with the forked workers: hits, misses, published
+stats = None
+
+FICLONE = 0x40049409
+
+def getKey(task, aInputs, aOutputs):
+    """The task family, its significant parameters, and the content of its direct inputs."""
+    aPaths = [obj.path for obj in aInputs if hasattr(obj, 'path')]
+    mDigest = digest.digestMany(aPaths)
+    key = {
+        'family': task.get_task_family(),
+        'params': task.to_str_params(only_significant=True),
+        'inputs': [mDigest[p] for p in aPaths],
+        'outputs': len(aOutputs),
+        }
+    return md5(json.dumps(key, sort_keys=True).encode('UTF-8')).hexdigest()
+
+def getEntry(key):
+    return Path(root) / key[:2] / key
+
+def isOnDisk(obj):
+    # Streamed PipeTargets are FIFOs, or nothing at all, which can be neither digested nor copied
+    return not isinstance(obj, PipeTarget) or (not obj.isPiped() and os.path.exists(obj.path))
+
+def isCacheable(task, aInputs):
+    if not getattr(task, 'cacheOutputs', False): return False
+    aOutputs = flatten(task.output())
+    if any(isinstance(out, PipeTarget) and out.isPiped() for out in aOutputs): return False
+    if not all(isOnDisk(obj) for obj in aInputs): return False
+    return len(aOutputs) > 0 and all(isinstance(out, Target) for out in aOutputs)
+
+def copyFile(src, dest):
+    """
+    Copy one file by reflink, or by copying as the last resort. Never by hard link, so that
+    touching or changing the outputs in the work directory never changes the cache, and vice versa.
+    """
+    try:
+        with open(src, 'rb') as fpIn, open(dest, 'wb') as fpOut:
+            fcntl.ioctl(fpOut.fileno(), FICLONE, fpIn.fileno())
+        return
+    except OSError:
+        pass
+    shutil.copy2(src, dest)
+
+def copyAny(src, dest):
+    if os.path.isdir(src):
+        shutil.copytree(src, dest, copy_function=copyFile)
+    else:
+        copyFile(src, dest)
+
+def touchAll(path):
+    for d, _, aFiles in os.walk(path):
+        for f in aFiles:
+            os.utime(os.path.join(d, f))
+        os.utime(d)
+    if not os.path.isdir(path):
+        os.utime(path)
+
+def getSize(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, aFiles in os.walk(path) for f in aFiles)
+
+def restore(task, aInputs):
+    """Restore the outputs of a task from the cache, and return whether it was possible."""
+    if root is None or not isCacheable(task, aInputs): return False
+    aOutputs = flatten(task.output())
+    entry = getEntry(getKey(task, aInputs, aOutputs))
+    try:
+        if not entry.exists():
+            raise FileNotFoundError(entry)
+        for i, out in enumerate(aOutputs):
+            out.makedirs()
+            with out.pathWrite() as pathTmp:
+                copyAny(entry / str(i), pathTmp)
+                # Restored outputs count as just built
+                touchAll(pathTmp)
+        os.utime(entry)
+    except FileNotFoundError:
+        # Not cached, or evicted just now
+        with stats.get_lock():
+            stats[1] += 1
+        return False
+    with stats.get_lock():
+        stats[0] += 1
+    logger.info("Restored {} from the output cache".format(task))
+    return True
+
+def publish(task, aInputs):
+    """Put the outputs of a task into the cache, if not already there."""
+    if root is None or not isCacheable(task, aInputs): return
+    aOutputs = flatten(task.output())
+    entry = getEntry(getKey(task, aInputs, aOutputs))
+    if entry.exists(): return
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    dirTmp = tempfile.mkdtemp(prefix='.tmp-', dir=entry.parent)
+    try:
+        for i, out in enumerate(aOutputs):
+            copyAny(out.path, os.path.join(dirTmp, str(i)))
+        with open(os.path.join(dirTmp, 'meta.json'), 'w') as fpw:
+            json.dump({'task': repr(task), 'size': sum(getSize(out.path) for out in aOutputs), 'time': time.time()}, fpw)
+        os.rename(dirTmp, entry)
+    except OSError as ex:
+        shutil.rmtree(dirTmp, ignore_errors=True)
+        if ex.errno in (errno.EEXIST, errno.ENOTEMPTY): return # Someone else was faster
+        raise
+    with stats.get_lock():
+        stats[2] += 1
+    evict()
+
+def evict():
+    """Remove the least recently used entries until the cache fits in the size limit."""
+    if sizeMax is None: return
+    aEntries = []
+    for dirPrefix in Path(root).iterdir():
+        if not dirPrefix.is_dir(): continue
+        for entry in dirPrefix.iterdir():
+            if entry.name.startswith('.'): continue # Being published or removed
+            try:
+                size = json.loads((entry / 'meta.json').read_text())['size']
+                aEntries.append((entry.stat().st_mtime, size, entry))
+            except (OSError, ValueError):
+                pass # Removed just now
+    sizeTotal = sum(size for _, size, _ in aEntries)
+    for _, size, entry in sorted(aEntries):
+        if sizeTotal <= sizeMax: break
+        # Rename first, so that nobody restores from a half-removed entry
+        pathTrash = entry.parent / '.trash-{}'.format(entry.name)
+        try:
+            os.rename(entry, pathTrash)
+        except OSError:
+            continue
+        shutil.rmtree(pathTrash, ignore_errors=True)
+        sizeTotal -= size
+
+def runWithCache(task, fnRun):
+    """
+    Restore the outputs of the task from the cache, or run it by fnRun() and publish its outputs,
+    if fnRun() returns None, meaning the task is done.
+    """
+    if root is None:
+        return fnRun()
+    aInputs = resolver.node(task)[0]
+    if not isCacheable(task, aInputs):
+        return fnRun()
+    if restore(task, aInputs):
+        return None
+    rtn = fnRun()
+    if rtn is None:
+        publish(task, aInputs)
+    return rtn
+
+def getSummary():
+    return '{} hits, {} misses, {} published'.format(*stats)
+
+@contextmanager
+def scope(path, size=None):
+    """Use the output cache in `path`, holding at most `size` bytes, within the context."""
+    global root, sizeMax, stats
+    if path is None:
+        yield
+        return
+    Path(path).mkdir(parents=True, exist_ok=True)
+    root = os.path.abspath(path)
+    sizeMax = size
+    stats = multiprocessing.Array('l', 3)
+    try:
+        yield
+    finally:
+        root = None
+        sizeMax = None
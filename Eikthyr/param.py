@@ -13,7 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import pickle
+import weakref
 from base64 import b85encode, b85decode
 from pathlib import Path
 
@@ -53,38 +55,81 @@ class WhateverParameter(lg.Parameter):
     def serializeShort(self, x):
         return self.serialize(x)
 
+# All tasks serialized in this process, so that they can be restored from their task_id
+# Only as long as they are alive anyway, e.g. in luigi's instance cache or the graph of a build
+mTaskById = weakref.WeakValueDictionary()
+
+def serializeTask(x):
+    mTaskById[x.task_id] = x
+    return x.task_id
+
+def parseTask(taskId):
+    try:
+        return mTaskById[taskId]
+    except KeyError:
+        raise ValueError("Task '{}' is not known in this process".format(taskId)) from None
+
+# The outputs of a task for display, computed only once for each task
+def getOutputsShort(task):
+    try:
+        return task._aOutputsShort
+    except AttributeError:
+        pass
+    aRepr = []
+    for out in flatten(task.output()):
+        if hasattr(out, 'pathRel'):
+            aRepr.append(out.pathRel)
+        elif hasattr(out, 'path'):
+            aRepr.append(out.path)
+        else:
+            aRepr.append(repr(out))
+    task._aOutputsShort = aRepr
+    return aRepr
+
 # TODO: Test
 class TaskParameter(WhateverParameter):
-    """A task, presumed to be pulled in as a dependency."""
+    """A task, presumed to be pulled in as a dependency.
+
+    The task is serialized as its own task_id, so the identity of a task doesn't grow with its ancestry.
+    Parsing only works for tasks already serialized within the same process.
+    """
 
     def _warn_on_wrong_param_type(self, param_name, param_value):
         pass # TODO: lg.Task?
 
+    # ':' never appears in base85, so this can't be confused with the pickled form
+    def serialize(self, x):
+        if isinstance(x, lg.Task):
+            return 'task:' + serializeTask(x)
+        return super().serialize(x)
+
+    def parse(self, x):
+        if x.startswith('task:'):
+            return parseTask(x[5:])
+        return super().parse(x)
+
     def serializeShort(self, x):
-        aRepr = []
-        for out in flatten(x.output()):
-            if hasattr(out, 'pathRel'):
-                aRepr.append(out.pathRel)
-            elif hasattr(out, 'path'):
-                aRepr.append(out.path)
-            else:
-                aRepr.append(repr(out))
-        return ';'.join(sorted(aRepr))
+        return ';'.join(sorted(getOutputsShort(x)))
 
 # TODO: Test
 class TaskListParameter(WhateverParameter):
-    """A list of tasks, presumed to be pulled in as dependencies."""
+    """A list of tasks, presumed to be pulled in as dependencies.
+
+    The tasks are serialized as the list of their task_id, as in `TaskParameter`.
+    """
 
     def _warn_on_wrong_param_type(self, param_name, param_value):
         pass # TODO: lg.Task?
 
+    def serialize(self, xs):
+        if all(isinstance(x, lg.Task) for x in xs):
+            return 'tasks:' + json.dumps([serializeTask(x) for x in xs])
+        return super().serialize(xs)
+
+    def parse(self, x):
+        if x.startswith('tasks:'):
+            return tuple(parseTask(taskId) for taskId in json.loads(x[6:]))
+        return super().parse(x)
+
     def serializeShort(self, xs):
-        aRepr = []
-        for out in flatten((x.output() for x in xs)):
-            if hasattr(out, 'pathRel'):
-                aRepr.append(out.pathRel)
-            elif hasattr(out, 'path'):
-                aRepr.append(out.path)
-            else:
-                aRepr.append(repr(out))
-        return ';'.join(sorted(aRepr))
+        return ';'.join(sorted(out for x in xs for out in getOutputsShort(x)))
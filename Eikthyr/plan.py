@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2023, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+import luigi as lg
+
+from . import cache
+from . import buildstate
+from . import envcheck
+from .state import db
+from .target import statCache, setUnstreamed
+from .task import BaseTask, resolver
+from .run import prefetch, getOutputPaths, withTaskSettings
+
+def getStaleReason(task):
+    if isinstance(task, BaseTask):
+        return task.getStaleReason()
+    # Plain luigi tasks can only tell whether they are complete
+    return None if task.complete() else 'incomplete'
+
+def plan(tasks, stat_cache=True, prefetch_threads=16, check_digest=None, build_state=False):
+    """
+    Return [(task, reason)] of the tasks run() would run, dependencies first, without running anything.
+
+    As in luigi, the dependencies of a complete task are not looked at. The requirements and
+    file status are resolved only once for the whole graph. Nothing in the state database or
+    the work directory is changed.
+    """
+    if isinstance(tasks, lg.Task):
+        tasks = (tasks,)
+    statCache.enabled = stat_cache
+    buildstate.enabled = build_state
+    db.readOnly = True
+    try:
+        with cache.scope(), withTaskSettings(checkDigest=check_digest):
+            envcheck.resolveAll(prefetch_threads)
+            if stat_cache and prefetch_threads > 0:
+                prefetch(getOutputPaths(tasks), prefetch_threads)
+
+            # Post-order walk from the specified tasks, stopping at complete ones
+            mReason = {}
+            aPlan = []
+            aStack = [(t, False) for t in reversed(tasks)]
+            while len(aStack) > 0:
+                t, isExpanded = aStack.pop()
+                if isExpanded:
+                    aPlan.append((t, mReason[t]))
+                    continue
+                if t in mReason: continue
+                mReason[t] = getStaleReason(t)
+                if mReason[t] is None: continue
+                aStack.append((t, True))
+                aStack.extend((d, False) for d in reversed(resolver.node(t)[1]) if d not in mReason)
+    finally:
+        buildstate.enabled = False
+        db.readOnly = False
+        setUnstreamed.clear()
+    return aPlan
+
+def formatPlan(aPlan, fmt='text'):
+    """Format a plan as lines of tab-separated task id and reason, or as JSON lines."""
+    if fmt == 'json':
+        return ''.join(json.dumps({'task': t.task_id, 'repr': repr(t), 'reason': reason}) + '\n' for t, reason in aPlan)
+    return ''.join('{}\t{}\n'.format(t.task_id, reason) for t, reason in aPlan)
@@ -13,33 +13,301 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import time
+import heapq
+import multiprocessing
+from contextlib import contextmanager
 from datetime import timedelta
 
 import luigi as lg
 from luigi.interface import _WorkerSchedulerFactory
-from luigi import worker
+from luigi import worker, scheduler
+from luigi.task import flatten
 
+from . import _ensureEnv
+from . import cache
+from . import buildstate
+from . import outputcache
+from . import envcheck
+from . import trace as tracing
+from .executor import LocalExecutor
+from .target import Target, statCache, cleanTrash
+from .task import BaseTask, resolver, isKnownComplete
 from .logging import logger
 
+class _EikthyrTaskProcess(worker.ContextManagedTaskProcess):
+    """A luigi task process which takes the outputs from the output cache instead of running the task, if possible."""
+
+    def _run_get_new_deps(self):
+        return outputcache.runWithCache(self.task, super()._run_get_new_deps)
+
+class _EikthyrWorker(worker.Worker):
+    """A luigi worker which also records when each task started and finished."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.aTimeline = []
+        self.mStarted = {}
+
+    # Mostly copied from the original luigi, except for the class of the task process
+    def _create_task_process(self, task):
+        message_queue = multiprocessing.Queue() if task.accepts_messages else None
+        reporter = worker.TaskStatusReporter(self._scheduler, task.task_id, self._id, message_queue)
+        use_multiprocessing = self._config.force_multiprocessing or bool(self.worker_processes > 1)
+        return _EikthyrTaskProcess(
+            self._config.task_process_context,
+            task,
+            self._id,
+            self._task_result_queue,
+            reporter,
+            use_multiprocessing=use_multiprocessing,
+            worker_timeout=self._config.timeout,
+            check_unfulfilled_deps=self._config.check_unfulfilled_deps,
+            check_complete_on_run=self._config.check_complete_on_run,
+            task_completion_cache=self._task_completion_cache,
+            )
+
+    def _run_task(self, task_id):
+        if task_id not in self._running_tasks:
+            self.mStarted[task_id] = time.time()
+        super()._run_task(task_id)
+
+    def _handle_next_task(self):
+        super()._handle_next_task()
+        for task_id in [t for t in self.mStarted if t not in self._running_tasks]:
+            self.aTimeline.append((self._scheduled_tasks[task_id], self.mStarted.pop(task_id), time.time()))
+
 class _EikthyrFactory(_WorkerSchedulerFactory):
+    def __init__(self, resources=None):
+        super().__init__()
+        self.resources = resources
+
+    def create_local_scheduler(self):
+        return scheduler.Scheduler(prune_on_get_work=True, record_task_history=False, resources=self.resources)
+
     def create_worker(self, scheduler, worker_processes, assistant=False):
         # Based on the suggestions in https://github.com/spotify/luigi/issues/2992
-        return worker.Worker(scheduler=scheduler, worker_processes=worker_processes, assistant=assistant,
+        return _EikthyrWorker(scheduler=scheduler, worker_processes=worker_processes, assistant=assistant,
                 check_complete_on_run=True,
                 check_unfulfilled_deps=False,
                 keep_alive=True,
                 max_keep_alive_idle_duration=timedelta(seconds=1)
                 )
 
-def run(tasks, print_summary=True, workers=1):
+# The capacity of this machine: all cores (or as many as the workers), and the physical memory in MB
+def getCapacity(workers, resources=None):
+    capacity = {'cores': max(os.cpu_count() or 1, workers)}
+    try:
+        capacity['memory'] = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1<<20)
+    except (ValueError, OSError, AttributeError):
+        pass
+    if resources is not None:
+        capacity.update(resources)
+    return capacity
+
+def getUtilization(aTimeline, capacity):
+    """Return {resource: (average fraction of capacity used, peak amount used)} over the time tasks were running."""
+    if len(aTimeline) == 0: return {}
+    tWall = max(tEnd for _, _, tEnd in aTimeline) - min(tStart for _, tStart, _ in aTimeline)
+    rslt = {}
+    aNames = list(capacity) + sorted({name for task, _, _ in aTimeline for name in (task.process_resources() or {})} - set(capacity))
+    for name in aNames:
+        amount = capacity.get(name, 1) # As in luigi
+        aEvents = []
+        for task, tStart, tEnd in aTimeline:
+            need = (task.process_resources() or {}).get(name, 0)
+            if need > 0:
+                aEvents.append((tStart, need))
+                aEvents.append((tEnd, -need))
+        if len(aEvents) == 0: continue
+        aEvents.sort()
+        used = peak = area = 0
+        tPrev = aEvents[0][0]
+        for t, delta in aEvents:
+            area += used * (t - tPrev)
+            used += delta
+            peak = max(peak, used)
+            tPrev = t
+        rslt[name] = (area / (amount * tWall) if tWall > 0 else 1.0, peak)
+    return rslt
+
+def getCriticalPath(aTimeline, fnDeps):
+    """Return the chain of tasks with the longest total running time, which bounds the wall time of the build."""
+    mDur = {task: tEnd - tStart for task, tStart, tEnd in aTimeline}
+    mFinish = {}
+    mPrev = {}
+    # A task always starts after all its dependencies end, so the start time is a topological order
+    for task, _, _ in sorted(aTimeline, key=lambda x: x[1]):
+        aDeps = [d for d in fnDeps(task) if d in mFinish]
+        prev = max(aDeps, key=lambda d: mFinish[d], default=None)
+        mPrev[task] = prev
+        mFinish[task] = mDur[task] + (0.0 if prev is None else mFinish[prev])
+    if len(mFinish) == 0: return []
+    aPath = [max(mFinish, key=lambda t: mFinish[t])]
+    while mPrev[aPath[-1]] is not None:
+        aPath.append(mPrev[aPath[-1]])
+    return aPath[::-1]
+
+def simulateMakespan(aTimeline, fnDeps, workers):
+    """
+    Estimate the wall time of running the same tasks with the measured durations on a number of workers,
+    starting the ready tasks in the order they actually started. Resources are not considered.
+    """
+    aTasks = sorted(aTimeline, key=lambda x: x[1])
+    mOrder = {task: i for i, (task, _, _) in enumerate(aTasks)}
+    mDur = {task: tEnd - tStart for task, tStart, tEnd in aTasks}
+    mWaiting = {}
+    mDependents = {task: [] for task in mOrder}
+    for task in mOrder:
+        aDeps = {d for d in fnDeps(task) if d in mOrder}
+        mWaiting[task] = len(aDeps)
+        for d in aDeps:
+            mDependents[d].append(task)
+    aReady = [mOrder[t] for t, n in mWaiting.items() if n == 0]
+    heapq.heapify(aReady)
+    aRunning = [] # (tEnd, order)
+    t = 0.0
+    while len(aReady) > 0 or len(aRunning) > 0:
+        while len(aReady) > 0 and len(aRunning) < workers:
+            i = heapq.heappop(aReady)
+            heapq.heappush(aRunning, (t + mDur[aTasks[i][0]], i))
+        t, i = heapq.heappop(aRunning)
+        for task in mDependents[aTasks[i][0]]:
+            mWaiting[task] -= 1
+            if mWaiting[task] == 0:
+                heapq.heappush(aReady, mOrder[task])
+    return t
+
+def getParallelismReport(aTimeline, fnDeps, workers, aWorkersSim=None):
+    """
+    Return the critical path, the average and peak number of tasks running together, the total
+    idle time of the workers, and the simulated wall time for other numbers of workers.
+    """
+    if len(aTimeline) == 0: return None
+    mDeps = {task: tuple(fnDeps(task)) for task, _, _ in aTimeline}
+    fnDeps = mDeps.__getitem__
+    tWall = max(tEnd for _, _, tEnd in aTimeline) - min(tStart for _, tStart, _ in aTimeline)
+    tBusy = sum(tEnd - tStart for _, tStart, tEnd in aTimeline)
+    aEvents = sorted([(tStart, 1) for _, tStart, _ in aTimeline] + [(tEnd, -1) for _, _, tEnd in aTimeline])
+    running = peak = 0
+    for _, delta in aEvents:
+        running += delta
+        peak = max(peak, running)
+    aPath = getCriticalPath(aTimeline, fnDeps)
+    mDur = {task: tEnd - tStart for task, tStart, tEnd in aTimeline}
+    if aWorkersSim is None:
+        aWorkersSim = sorted({1, max(workers // 2, 1), workers, workers * 2, workers * 4})
+    return {
+        'wall': tWall,
+        'criticalPath': [(task, mDur[task]) for task in aPath],
+        'criticalTime': sum(mDur[task] for task in aPath),
+        'parallelismAvg': tBusy / tWall if tWall > 0 else 1.0,
+        'parallelismPeak': peak,
+        'idle': max(workers * tWall - tBusy, 0.0),
+        'makespan': {w: simulateMakespan(aTimeline, fnDeps, w) for w in aWorkersSim},
+        }
+
+def logParallelismReport(report, workers):
+    logger.info("Critical path: {:.1f}s of {:.1f}s wall time, through {} tasks".format(
+        report['criticalTime'], report['wall'], len(report['criticalPath'])))
+    for task, t in report['criticalPath']:
+        logger.debug("  {:.1f}s {}".format(t, task))
+    logger.info("Parallelism: average {:.2f}, peak {}; idle worker time {:.1f}s".format(
+        report['parallelismAvg'], report['parallelismPeak'], report['idle']))
+    logger.info("Simulated wall time: {}".format(', '.join('{}{} workers {:.1f}s'.format(
+        '*' if w == workers else '', w, t) for w, t in report['makespan'].items())))
+
+def getOutputPaths(tasks):
+    return [out.path for t in resolver.walk(tasks, isKnownComplete)
+            for out in flatten(t.output()) if isinstance(out, Target)]
+
+# Stat all targets in the graph at once, before luigi checks the tasks one by one
+def prefetch(aPaths, nThreads):
+    t0 = time.time()
+    nStat = statCache.prefetch(aPaths, nThreads)
+    logger.debug("Prefetched {} paths in {:.3f}s".format(nStat, time.time() - t0))
+
+# Override the default settings of all tasks within the context, if not None
+@contextmanager
+def withTaskSettings(**kwargs):
+    kwargs = {k: v for k, v in kwargs.items() if v is not None}
+    settingsOld = {k: getattr(BaseTask, k) for k in kwargs}
+    for k, v in kwargs.items():
+        setattr(BaseTask, k, v)
+    try:
+        yield
+    finally:
+        for k, v in settingsOld.items():
+            setattr(BaseTask, k, v)
+
+def run(tasks, print_summary=True, workers=1, stat_cache=True, prefetch_threads=16, check_digest=None,
+        build_state=False, resources=None, log_dir=None, log_compress=None, log_live=None, trace=None,
+        executor='luigi', output_cache=None, output_cache_size=None):
+    """
+    Run the tasks and everything they depend on.
+
+    Each task takes the resources it declares (`cores`, `memory` in MB, and any named `tokens`),
+    and tasks only run together when they fit in the capacity of this machine, which can be
+    overridden by `resources`. A named token not found in the capacity is available only once.
+
+    If `log_dir` is specified, the output of the commands of each task goes into its own log file
+    there, instead of the terminal.
+
+    The `executor` runs the tasks: 'luigi' goes through the luigi scheduler, while 'local' runs them
+    directly without the scheduling overhead, in forked processes like luigi when there are more workers,
+    and 'threads' runs them in threads instead, which is only safe for tasks not changing the working directory.
+
+    If `output_cache` is specified as a directory, which may be shared by many work directories, the outputs
+    of tasks are restored from there when a task with the same parameters was run on the same input content
+    before, instead of running it again. Outputs are put there after each run, and the least recently used
+    ones are removed when it grows beyond `output_cache_size` bytes.
+
+    If `trace` is specified, the time spent in each phase of each task (complete(), requires(),
+    waiting in the queue, run(), and each command) is written there as a Chrome trace, which can
+    be opened in Perfetto or chrome://tracing, and a summary of it into `*.summary.json` beside.
+    """
+    if executor not in ('luigi', 'local', 'threads'):
+        raise ValueError("Unknown executor '{}'".format(executor))
     if isinstance(tasks, lg.Task):
         tasks = (tasks,)
+    _ensureEnv()
+    statCache.enabled = stat_cache
+    buildstate.enabled = build_state
+    capacity = getCapacity(workers, resources)
     t0 = time.time()
-    rtn = lg.build(tasks, local_scheduler=True, log_level='WARNING', detailed_summary=True,
-            workers=workers, worker_scheduler_factory=_EikthyrFactory())
+    try:
+        with tracing.scope(trace), outputcache.scope(output_cache, output_cache_size), cache.scope(), withTaskSettings(checkDigest=check_digest,
+                logDir=None if log_dir is None else os.path.abspath(log_dir),
+                logCompress=log_compress, logLive=log_live):
+            envcheck.resolveAll(prefetch_threads)
+            nTrash = cleanTrash()
+            if nTrash > 0:
+                logger.info("Deleting {} old directories left from before".format(nTrash))
+            if stat_cache and prefetch_threads > 0:
+                prefetch(getOutputPaths(tasks), prefetch_threads)
+            tBuild = time.time()
+            if executor == 'luigi':
+                rtn = lg.build(tasks, local_scheduler=True, log_level='WARNING', detailed_summary=True,
+                        workers=workers, worker_scheduler_factory=_EikthyrFactory(capacity))
+            else:
+                rtn = LocalExecutor(workers, capacity, None if executor == 'local' else False).build(tasks)
+            tracing.addQueueEvents(rtn.worker.aTimeline, tBuild, lambda t: resolver.node(t)[1])
+            # While the requirements are still cached
+            report = getParallelismReport(rtn.worker.aTimeline, lambda t: resolver.node(t)[1], workers) if print_summary else None
+    finally:
+        buildstate.enabled = False
     if print_summary:
         logger.info("Total Time Spent: {:.3f}s".format(time.time() - t0))
+        logger.debug("Cache usage: {}".format(cache.summary()))
+        if output_cache is not None:
+            logger.info("Output cache: {}".format(outputcache.getSummary()))
+        mUtil = getUtilization(rtn.worker.aTimeline, capacity)
+        if len(mUtil) > 0:
+            logger.info("Utilization: {}".format(', '.join('{} {:.1%} (peak {}/{})'.format(
+                name, ratio, peak, capacity.get(name, 1)) for name, (ratio, peak) in mUtil.items())))
+        if report is not None:
+            logParallelismReport(report, workers)
         logger.debug(rtn.summary_text)
     if rtn.status != lg.LuigiStatusCode.SUCCESS and rtn.status != lg.LuigiStatusCode.SUCCESS_WITH_RETRY:
         raise RuntimeError("Luigi task run failed")
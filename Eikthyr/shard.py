@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2023, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import abc
+import json
+from pathlib import Path
+
+import luigi as lg
+
+from .target import Target, statCache
+from .param import TaskParameter
+from .task import BaseTask, Task
+from .specialtask import InputTask
+
+SIZE_CHUNK = 1 << 20
+
+def copyRange(fpIn, fpOut, offset, length):
+    """Copy a byte range between two files, within the kernel if possible."""
+    fpOut.flush()
+    try:
+        while length > 0:
+            n = os.copy_file_range(fpIn.fileno(), fpOut.fileno(), length, offset)
+            if n == 0: break
+            offset += n
+            length -= n
+        return
+    except (AttributeError, OSError):
+        pass # Not Linux, or not possible between these files: copy the rest in userspace
+    fpIn.seek(offset)
+    while length > 0:
+        buf = fpIn.read(min(length, SIZE_CHUNK))
+        if not buf: break
+        fpOut.write(buf)
+        length -= len(buf)
+
+def isSameRange(fpIn, offset, length, path):
+    """Check whether a file has exactly the same content as a byte range of another file."""
+    st = statCache.stat(path)
+    if st is None or st.st_size != length:
+        return False
+    fpIn.seek(offset)
+    with open(path, 'rb') as fp:
+        while length > 0:
+            buf = fp.read(min(length, SIZE_CHUNK))
+            if not buf or buf != fpIn.read(len(buf)):
+                return False
+            length -= len(buf)
+    return True
+
+def getLineOffsets(path, aLineNos):
+    """Return the byte offset right after each of the specified line numbers, which must be sorted."""
+    rslt = []
+    it = iter(aLineNos)
+    target = next(it, None)
+    nLine = pos = 0
+    with open(path, 'rb') as fp:
+        while target is not None:
+            buf = fp.read(SIZE_CHUNK)
+            if not buf: break
+            start = 0
+            while target is not None and nLine + buf.count(b'\n', start) >= target:
+                for _ in range(target - nLine):
+                    start = buf.index(b'\n', start) + 1
+                nLine = target
+                rslt.append(pos + start)
+                target = next(it, None)
+            nLine += buf.count(b'\n', start)
+            pos += len(buf)
+    size = os.path.getsize(path)
+    return rslt + [size] * (len(aLineNos) - len(rslt))
+
+def countLines(path):
+    nLine = 0
+    buf = b''
+    with open(path, 'rb') as fp:
+        while True:
+            bufNew = fp.read(SIZE_CHUNK)
+            if not bufNew: break
+            buf = bufNew
+            nLine += buf.count(b'\n')
+    if len(buf) > 0 and not buf.endswith(b'\n'):
+        nLine += 1
+    return nLine
+
+def getBoundaries(path, nShard, by='lines'):
+    """
+    Return the nShard+1 byte offsets dividing a file into shards, either with about the same
+    number of lines, or about the same number of bytes. Shards always end at line boundaries.
+    """
+    size = os.path.getsize(path)
+    if by == 'lines':
+        nLine = countLines(path)
+        aOffsets = getLineOffsets(path, [nLine * i // nShard for i in range(1, nShard)])
+    elif by == 'bytes':
+        aOffsets = []
+        with open(path, 'rb') as fp:
+            for i in range(1, nShard):
+                offset = max(size * i // nShard, aOffsets[-1] if len(aOffsets) > 0 else 0)
+                if offset > 0:
+                    fp.seek(offset - 1)
+                    fp.readline()
+                    offset = fp.tell()
+                aOffsets.append(offset)
+    else:
+        raise ValueError("Unknown way to split shards: '{}'".format(by))
+    return [0] + aOffsets + [size]
+
+class ShardMapTask(BaseTask):
+    """Process one shard of a ShardTask, with the command from its mapShard()."""
+    parent = TaskParameter()
+    idx = lg.IntParameter()
+
+    @property
+    def resources(self):
+        return self.parent.resources
+
+    def requires(self):
+        return InputTask(self.parent.getShardInput(self.idx))
+
+    def output(self):
+        return Target(self.parent.getShardOutput(self.idx))
+
+    def run(self):
+        with self.output().pathWrite() as pathOut:
+            self.ex(self.parent.mapShard(self.input().path, pathOut))
+
+class ShardTask(Task):
+    """
+    A task processing one big input file in shards.
+
+    The input is split into `nShard` files, by `shardBy` 'lines' or 'bytes', and each is processed
+    by the command from mapShard(pathIn, pathOut) as a separate task, so that they run in parallel.
+    The results are then concatenated in order into the output.
+    Only the shards whose content has changed are processed again.
+    """
+    nShard = 4
+    shardBy = 'lines'
+
+    @abc.abstractmethod
+    def mapShard(self, pathIn, pathOut):
+        """Return the plumbum command processing one shard from pathIn into pathOut."""
+
+    def getShardDir(self):
+        return Path(self.output().path + '.shards')
+
+    def getShardInput(self, idx):
+        return self.getShardDir() / 'in-{:05d}'.format(idx)
+
+    def getShardOutput(self, idx):
+        return self.getShardDir() / 'out-{:05d}'.format(idx)
+
+    def getShardTasks(self):
+        return [ShardMapTask(self, i) for i in range(self.nShard)]
+
+    def run(self):
+        self.split()
+        yield self.getShardTasks()
+        self.merge()
+
+    def split(self):
+        pathSrc = self.input().path
+        st = os.stat(pathSrc)
+        pathIndex = self.getShardDir() / 'index.json'
+        mIndex = {'src': os.path.abspath(pathSrc), 'size': st.st_size, 'mtime': st.st_mtime_ns,
+                'nShard': self.nShard, 'by': self.shardBy}
+        # When run again after the shard tasks are done, the shards are already there
+        if pathIndex.exists() and json.loads(pathIndex.read_text()) == mIndex:
+            return
+
+        aOffsets = getBoundaries(pathSrc, self.nShard, self.shardBy)
+        with open(pathSrc, 'rb') as fpIn:
+            for i in range(self.nShard):
+                offset, length = aOffsets[i], aOffsets[i+1] - aOffsets[i]
+                target = Target(self.getShardInput(i))
+                # Leave the unchanged shards alone, so that their tasks stay complete
+                if isSameRange(fpIn, offset, length, target.path):
+                    continue
+                with target.pathWrite() as pathOut, open(pathOut, 'wb') as fpOut:
+                    copyRange(fpIn, fpOut, offset, length)
+        self.removeExtraShards()
+        with Target(pathIndex).fpWrite() as fpw:
+            json.dump(mIndex, fpw)
+
+    def removeExtraShards(self):
+        # Left behind by a larger nShard before
+        for path in self.getShardDir().glob('*-*'):
+            prefix, _, idx = path.name.partition('-')
+            if prefix in ('in', 'out') and idx.isdigit() and int(idx) >= self.nShard:
+                os.unlink(path)
+                statCache.forget(path)
+
+    def merge(self):
+        with self.output().pathWrite() as pathOut, open(pathOut, 'wb') as fpOut:
+            for i in range(self.nShard):
+                pathShard = self.getShardOutput(i)
+                with open(pathShard, 'rb') as fpIn:
+                    copyRange(fpIn, fpOut, 0, os.path.getsize(pathShard))
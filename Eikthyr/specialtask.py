@@ -25,12 +25,13 @@ from .task import BaseTask, Task
 # Wrapper for an input file
 class InputTask(BaseTask):
     src = PathParameter()
+    cacheOutputs = False
 
     def requires(self):
         return []
 
     def output(self):
-        return Target(self, self.src)
+        return Target(self.src)
 
     def run(self):
         if not Path(self.src).exists():
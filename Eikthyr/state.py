@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2023, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sqlite3
+from pathlib import Path
+
+# The directory holding the persistent state of Eikthyr, relative to the work directory
+def getStateDir():
+    return Path(os.getenv('EIKTHYR_STATE_DIR', '.eikthyr'))
+
+class StateDB(object):
+    """The persistent state of Eikthyr in the work directory, kept as an SQLite database.
+
+    Each process opens its own connection (a connection must not be shared across fork),
+    and SQLite takes care of the locking when several worker processes write at once.
+    Nothing is written while `readOnly` is set, e.g. within plan().
+    """
+
+    def __init__(self):
+        self.readOnly = False
+        self.aSchemas = []
+        self.conn = None
+        self.pid = None
+        self.path = None
+
+    def addSchema(self, sql):
+        self.aSchemas.append(sql)
+        self.conn = None
+
+    def connect(self):
+        path = (getStateDir() / 'state.sqlite').resolve()
+        if self.conn is None or self.pid != os.getpid() or self.path != path or not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(str(path), timeout=60, isolation_level=None, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            for sql in self.aSchemas:
+                self.conn.execute(sql)
+            self.pid = os.getpid()
+            self.path = path
+        return self.conn
+
+    def execute(self, sql, *args):
+        return self.connect().execute(sql, args)
+
+    def write(self, sql, *args):
+        if self.readOnly: return
+        self.execute(sql, *args)
+
+    def executemany(self, sql, aArgs):
+        if self.readOnly: return
+        conn = self.connect()
+        with conn:
+            conn.execute('BEGIN')
+            conn.executemany(sql, aArgs)
+
+db = StateDB()
@@ -14,30 +14,175 @@
 # limitations under the License.
 
 import os
+import errno
 import json
+import mmap
+import stat
+import subprocess
+import tempfile
+import threading
+import uuid
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from hashlib import md5
 from pathlib import Path
-from shutil import rmtree
+from shutil import rmtree, which
 
 import luigi as lg
 from luigi.local_target import LocalFileSystem
+from luigi.format import InputPipeProcessWrapper, OutputPipeProcessWrapper
+
+from . import cache
+from . import digest
+from .state import getStateDir, db
+
+class StatCache(cache.BuildCache):
+    """A cache of os.stat() results keyed by absolute path, where `None` means the path doesn't exist.
+
+    Each hit is a stat syscall avoided, which matters a lot on network filesystems.
+    """
+
+    def __init__(self):
+        super().__init__('Stat', volatile=True)
+
+    def stat(self, path):
+        path = os.path.abspath(path)
+        return self.get(path, lambda: statOrNone(path))
+
+    def refresh(self, path):
+        """Write-through after committing a file: record its new stat, and drop anything derived from the old one."""
+        path = os.path.abspath(path)
+        if self.active:
+            self.data[path] = statOrNone(path)
+        cache.invalidateVolatile(exclude=(self,))
+
+    def prefetch(self, aPaths, nThreads=16):
+        """Stat many paths concurrently, so that later lookups don't pay the latency one by one."""
+        if not self.active: return 0
+        aPaths = {os.path.abspath(p) for p in aPaths}
+        aPaths = [p for p in aPaths if p not in self.data]
+        if len(aPaths) == 0: return 0
+        with ThreadPoolExecutor(max_workers=nThreads) as pool:
+            for path, st in zip(aPaths, pool.map(statOrNone, aPaths)):
+                self.data[path] = st
+        self.misses += len(aPaths)
+        return len(aPaths)
+
+    def forget(self, path):
+        self.invalidate(os.path.abspath(path))
+        cache.invalidateVolatile(exclude=(self,))
+
+    def __repr__(self):
+        return '{}: {} syscalls avoided, {} performed'.format(self.name, self.hits, self.misses)
+
+def statOrNone(path):
+    try:
+        return os.stat(path)
+    except OSError: # Also not there if a parent is a file, or can't be reached, like os.path.exists()
+        return None
+
+statCache = StatCache()
+
+cacheTreeMtime = cache.BuildCache('Tree mtime', volatile=True)
+
+def getTreeMtime(path, pattern=None, depth=None):
+    """
+    Return the newest mtime of a directory and everything inside it, down to `depth` levels.
+    If `pattern` is specified, only the files with a matching name are considered, though
+    the directories themselves always are, as their mtime changes when entries are removed.
+    """
+    mtime = os.stat(path).st_mtime
+    aStack = [(path, 0)]
+    while len(aStack) > 0:
+        pathDir, d = aStack.pop()
+        if depth is not None and d >= depth: continue
+        with os.scandir(pathDir) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        mtime = max(mtime, entry.stat(follow_symlinks=False).st_mtime)
+                        aStack.append((entry.path, d+1))
+                    elif pattern is None or fnmatch(entry.name, pattern):
+                        mtime = max(mtime, entry.stat().st_mtime)
+                except FileNotFoundError:
+                    pass # Broken symlinks, or things removed while walking
+    return mtime
+
+# Old directories being deleted in the background are renamed to this prefix
+PREFIX_TRASH = '.eikthyr-trash-'
+
+def getTrashRecordDir():
+    return getStateDir() / 'trash'
+
+def reapLater(path, pathRecord=None):
+    """
+    Delete a tree in the background, by a process detached from this one, so that it goes on even after this one exits.
+    The record of the pending deletion, if any, is removed once done.
+    """
+    try:
+        subprocess.run(['sh', '-c', '{ rm -rf -- "$0" && rm -f -- "$1"; } </dev/null >/dev/null 2>&1 &', path, pathRecord or ''], check=True)
+    except (OSError, subprocess.CalledProcessError):
+        def reap():
+            rmtree(path, ignore_errors=True)
+            if pathRecord is not None:
+                Path(pathRecord).unlink(missing_ok=True)
+        threading.Thread(target=reap, daemon=True).start()
+
+def moveToTrash(path):
+    """Rename a directory aside, record it as pending deletion in the state directory, and return the new path."""
+    pathTrash = Path(path).parent / '{}{}-{}'.format(PREFIX_TRASH, Path(path).name, uuid.uuid4().hex[:8])
+    os.rename(path, pathTrash)
+    dirRecord = getTrashRecordDir()
+    dirRecord.mkdir(parents=True, exist_ok=True)
+    pathRecord = dirRecord / pathTrash.name
+    pathRecord.write_text(str(pathTrash.resolve()))
+    return pathTrash, pathRecord
+
+def cleanTrash():
+    """Delete the old directories still recorded as pending deletion, e.g. when the last run crashed."""
+    dirRecord = getTrashRecordDir()
+    if not dirRecord.is_dir():
+        return 0
+    n = 0
+    for pathRecord in dirRecord.iterdir():
+        try:
+            pathTrash = pathRecord.read_text()
+        except FileNotFoundError:
+            continue # Done just now
+        # Never anything not renamed by moveToTrash()
+        if os.path.basename(pathTrash).startswith(PREFIX_TRASH) and os.path.lexists(pathTrash):
+            reapLater(pathTrash, str(pathRecord))
+            n += 1
+        else:
+            pathRecord.unlink(missing_ok=True)
+    return n
 
 class LocalOverwriteFileSystem(LocalFileSystem):
     def rename_dont_move(self, path, dest):
         pathDest = Path(dest)
         if pathDest.is_dir():
-            rmtree(dest)
-            self.move(path, dest)
+            # Swap the new one in first, and only then delete the old one without waiting
+            pathTrash, pathRecord = moveToTrash(dest)
+            try:
+                self.move(path, dest)
+            except BaseException:
+                os.rename(pathTrash, dest)
+                pathRecord.unlink(missing_ok=True)
+                raise
+            reapLater(str(pathTrash), str(pathRecord))
         else:
             pathDest.unlink(missing_ok=True)
             self.move(path, dest, raise_if_exists=False)
+        statCache.forget(path)
+        statCache.refresh(dest)
 
 class Target(lg.LocalTarget):
     fs = LocalOverwriteFileSystem()
 
-    def __init__(self, path, **kwargs):
+    def __init__(self, path, mtimeGlob=None, mtimeDepth=None, **kwargs):
         super().__init__(str(path), **kwargs)
+        self.mtimeGlob = mtimeGlob
+        self.mtimeDepth = mtimeDepth
         pathRel = Path(self.path)
         if pathRel.is_absolute():
             if pathRel.is_relative_to(Path.cwd()):
@@ -49,16 +194,34 @@ class Target(lg.LocalTarget):
     def __repr__(self):
         return '{}({})'.format(self.__class__.__name__, self.path)
 
+    def exists(self):
+        return statCache.stat(self.path) is not None
+
     def mtime(self):
         '''
         Get the last modification time of this target.
-        The file/dir modification time is used here.
+        The file modification time is used here. For a directory, it is the newest one among
+        everything inside, optionally limited by `mtimeGlob` and `mtimeDepth`.
         '''
-        return os.path.getmtime(self.path)
+        st = statCache.stat(self.path)
+        if st is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), self.path)
+        if stat.S_ISDIR(st.st_mode) and self.mtimeDepth != 0:
+            return cacheTreeMtime.get((os.path.abspath(self.path), self.mtimeGlob, self.mtimeDepth),
+                    lambda: getTreeMtime(self.path, self.mtimeGlob, self.mtimeDepth))
+        return st.st_mtime
+
+    def digest(self):
+        '''
+        Get the content digest of this target.
+        For a directory, all files inside are included.
+        '''
+        return digest.digestMany([self.path])[self.path]
 
     @contextmanager
     def pathWrite(self):
         self.makedirs()
+        # The stat cache is refreshed by the filesystem when the temporary path is renamed
         with self.temporary_path() as f:
             yield f
 
@@ -66,7 +229,223 @@ class Target(lg.LocalTarget):
     def fpWrite(self):
         with self.open('w') as fpw:
             yield fpw
+        statCache.refresh(self.path)
 
 class BinaryTarget(Target):
     def __init__(self, path, **kwargs):
         super().__init__(str(path), format=lg.format.Nop, **kwargs)
+
+    @contextmanager
+    def mmapRead(self):
+        '''
+        Map the whole file read-only within the context, so that it can be accessed randomly without reading it into memory.
+        Views into it, like memoryview() or numpy.frombuffer(), must be released before leaving the context.
+        '''
+        with open(self.path, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                yield b''
+                return
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mm
+        finally:
+            mm.close()
+
+    @contextmanager
+    def mmapWrite(self, size):
+        '''
+        Preallocate a temporary file of the specified size, and map it writable within the context.
+        The file is committed when leaving the context, in the same way as pathWrite().
+        '''
+        with self.pathWrite() as pathTmp, open(pathTmp, 'w+b') as fp:
+            if size == 0:
+                yield bytearray()
+                return
+            try:
+                # Reserve the space now, rather than fail with SIGBUS halfway through writing
+                os.posix_fallocate(fp.fileno(), 0, size)
+            except AttributeError:
+                fp.truncate(size)
+            except OSError as ex:
+                # Only when the filesystem can't do it; a full disk must fail right here
+                if ex.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+                fp.truncate(size)
+            mm = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_WRITE)
+            try:
+                yield mm
+                mm.flush()
+            finally:
+                mm.close()
+
+# Extension -> compression, and the commands for each compression, the first found being used
+mCompressionByExt = {'.gz': 'gzip', '.zst': 'zstd'}
+mCompressors = {
+        'gzip': (('pigz', '-c', '-p{threads}', '-{level}'), ('gzip', '-c', '-{level}')),
+        'zstd': (('zstd', '-c', '-q', '-T{threads}', '-{level}'),),
+        }
+mDecompressors = {
+        'gzip': (('pigz', '-dc'), ('gzip', '-dc')),
+        'zstd': (('zstd', '-dcq'),),
+        }
+mLevelDefault = {'gzip': 6, 'zstd': 3}
+
+def findCmd(aCmds, **kwargs):
+    for cmd in aCmds:
+        if which(cmd[0]) is not None:
+            return [arg.format(**kwargs) for arg in cmd]
+    raise OSError(errno.ENOENT, "None of the commands is available: {}".format(', '.join(cmd[0] for cmd in aCmds)))
+
+class CompressFormat(lg.format.Format):
+    """A luigi format streaming through an external compressor, which can use many threads."""
+    input = 'bytes'
+    output = 'bytes'
+
+    def __init__(self, compression, level=None, threads=None):
+        if compression not in mCompressors:
+            raise ValueError("Unknown compression '{}'".format(compression))
+        self.compression = compression
+        self.level = mLevelDefault[compression] if level is None else level
+        # 0 means as many as the cores
+        self.threads = (os.cpu_count() or 1) if threads is None or threads == 0 else threads
+
+    def getCmdCompress(self):
+        return findCmd(mCompressors[self.compression], threads=self.threads, level=self.level)
+
+    def getCmdDecompress(self):
+        return findCmd(mDecompressors[self.compression])
+
+    def pipe_reader(self, input_pipe):
+        return InputPipeProcessWrapper(self.getCmdDecompress(), input_pipe)
+
+    def pipe_writer(self, output_pipe):
+        return OutputPipeProcessWrapper(self.getCmdCompress(), output_pipe)
+
+class CompressedTarget(Target):
+    """
+    A target compressed with gzip or zstd, chosen by the extension (.gz or .zst) if not specified.
+
+    Reading and writing through open() and fpWrite() are streamed through the compressor.
+    pathWrite() gives a FIFO, so commands can write the uncompressed content there as usual,
+    as long as they write it sequentially.
+    """
+
+    def __init__(self, path, compression=None, level=None, threads=None, binary=False, **kwargs):
+        if compression is None:
+            compression = mCompressionByExt.get(os.path.splitext(str(path))[1])
+            if compression is None:
+                raise ValueError("Cannot tell the compression of '{}'".format(path))
+        self.formatCompress = CompressFormat(compression, level, threads)
+        super().__init__(path, format=self.formatCompress if binary else lg.format.Text >> self.formatCompress, **kwargs)
+
+    @contextmanager
+    def pathWrite(self):
+        self.makedirs()
+        cmd = self.formatCompress.getCmdCompress()
+        with self.temporary_path() as pathTmp:
+            dirFifo = tempfile.mkdtemp(prefix='eikthyr-fifo-')
+            try:
+                # Without the compression extension, so that tools choosing the format by it don't compress again
+                pathFifo = os.path.join(dirFifo, os.path.splitext(os.path.basename(self.path))[0])
+                os.mkfifo(pathFifo)
+                # Also hold a writing end here, so the compressor only sees the end after the whole context
+                fdRead = os.open(pathFifo, os.O_RDONLY | os.O_NONBLOCK)
+                fdWrite = os.open(pathFifo, os.O_WRONLY)
+                os.set_blocking(fdRead, True)
+                with open(pathTmp, 'wb') as fpOut:
+                    proc = subprocess.Popen(cmd, stdin=fdRead, stdout=fpOut)
+                os.close(fdRead)
+                try:
+                    yield pathFifo
+                finally:
+                    os.close(fdWrite)
+                    proc.wait()
+                if proc.returncode != 0:
+                    raise RuntimeError("Compression into {} failed with exit code {}".format(self.path, proc.returncode))
+            finally:
+                rmtree(dirFifo)
+
+# Paths of PipeTargets currently being streamed from a running producer to a running consumer
+setPiped = set()
+
+# Stamps only taken as dropped, as nothing may be changed on disk, i.e. within plan()
+setUnstreamed = set()
+
+class PipeTarget(Target):
+    """
+    A target which can be streamed from its producer to its only consumer through a FIFO,
+    without ever being written to disk, when they are run together by the local executor.
+    Otherwise, it is just a normal file.
+
+    When streamed, the consumer must read it exactly once from the beginning to the end.
+    Afterwards a stamp file `.<name>.streamed` beside records when it was streamed, and stands
+    for the file in exists() and mtime(), so that the producer and consumer stay complete.
+    Whenever the consumer has to run again, the stamp is dropped, so that the producer runs too.
+    """
+
+    def isPiped(self):
+        return os.path.abspath(self.path) in setPiped
+
+    def getStampPath(self):
+        # Left beside in place of the file after it was streamed, with the time it was streamed
+        d, name = os.path.split(self.path)
+        return os.path.join(d, '.{}.streamed'.format(name))
+
+    def isStreamed(self):
+        pathStamp = self.getStampPath()
+        return os.path.abspath(pathStamp) not in setUnstreamed and statCache.stat(pathStamp) is not None
+
+    def isStampOnly(self):
+        # Streamed before, and so only known from the stamp
+        return not self.isPiped() and statCache.stat(self.path) is None and self.isStreamed()
+
+    def markStreamed(self, t):
+        pathStamp = self.getStampPath()
+        with open(pathStamp, 'w'):
+            pass
+        os.utime(pathStamp, (t, t))
+        statCache.refresh(pathStamp)
+
+    def forgetStreamed(self):
+        pathStamp = self.getStampPath()
+        if db.readOnly:
+            setUnstreamed.add(os.path.abspath(pathStamp))
+            return
+        if os.path.lexists(pathStamp):
+            os.unlink(pathStamp)
+        statCache.forget(pathStamp)
+
+    def exists(self):
+        return self.isPiped() or super().exists() or self.isStreamed()
+
+    def mtime(self):
+        # Doesn't make anything newer or older while streaming
+        if self.isPiped():
+            return 0.0
+        if not super().exists() and self.isStreamed():
+            return statCache.stat(self.getStampPath()).st_mtime
+        return super().mtime()
+
+    def remove(self):
+        self.forgetStreamed()
+        if super().exists():
+            super().remove()
+
+    @contextmanager
+    def pathWrite(self):
+        if not self.isPiped():
+            with super().pathWrite() as f:
+                yield f
+            self.forgetStreamed()
+            return
+        yield self.path
+
+    @contextmanager
+    def fpWrite(self):
+        if not self.isPiped():
+            with super().fpWrite() as fpw:
+                yield fpw
+            self.forgetStreamed()
+            return
+        with open(self.path, 'w') as fpw:
+            yield fpw
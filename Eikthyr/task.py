@@ -15,44 +15,149 @@
 
 import time
 import pickle
+from contextlib import contextmanager, nullcontext
 from inspect import isgenerator
 from pathlib import Path
 
 import luigi as lg
-from luigi.task import flatten
+from luigi.task import flatten, getpaths
 from colorama import Fore, Style
 from plumbum import FG
+from plumbum.commands import ProcessExecutionError
 
-from .cmd import withEnv
-from .target import Target, BinaryTarget
+from . import cache
+from . import digest
+from . import buildstate
+from . import trace
+from . import envcheck
+from .cmd import withEnv, CmdPool, OutputCapture, runWithUsage
+from .target import Target, BinaryTarget, PipeTarget
 from .logging import logger
-from .param import TaskParameter, TaskListParameter
+from .param import TaskParameter, TaskListParameter, mTaskById
+
+class InputResolver(object):
+    """Resolve the transitive inputs of tasks.
+
+    The requirements of each task are only evaluated once per build, and the results
+    aggregated over the dependency graph are shared between all the tasks downstream.
+    """
+
+    def __init__(self):
+        self.cacheNode = cache.BuildCache('Task requirements')
+        self.cacheNewest = cache.BuildCache('Newest input', volatile=True)
+
+    def node(self, task):
+        """Direct input targets and the dependencies of a task."""
+        def compute():
+            # Same as task.input() and task._requires(), but only calling requires() once
+            with trace.span('requires', 'requires', task=task):
+                req = task.requires()
+            return (tuple(flatten(getpaths(req))), tuple(flatten(req) + list(getattr(task, 'prev', ()))))
+        return self.cacheNode.get(task, compute)
+
+    def walk(self, aTask, fnPrune=None):
+        """
+        Yield every task in the graph under the specified tasks, each only once.
+        The dependencies of the tasks for which `fnPrune` returns `True` are not visited.
+        """
+        aStack = list(aTask)
+        setSeen = set(aStack)
+        while len(aStack) > 0:
+            t = aStack.pop()
+            yield t
+            if fnPrune is not None and fnPrune(t): continue
+            for d in self.node(t)[1]:
+                if d not in setSeen:
+                    setSeen.add(d)
+                    aStack.append(d)
+
+    def getAllInputTargets(self, aTask):
+        setRslt = set()
+        for t in self.walk(aTask):
+            setRslt.update(self.node(t)[0])
+        return setRslt
+
+    def newestInput(self, task):
+        """
+        Return the newest modification time among all transitive inputs of a task,
+        or `None` if none of them can be checked.
+        """
+        memo = self.cacheNewest.memo()
+        if task in memo:
+            self.cacheNewest.hits += 1
+            return memo[task]
+        self.cacheNewest.misses += 1
+
+        # Post-order walk, so that each dependency is aggregated before its dependents
+        aStack = [(task, False)]
+        while len(aStack) > 0:
+            t, isExpanded = aStack.pop()
+            if t in memo: continue
+            aInputs, aDeps = self.node(t)
+            if not isExpanded:
+                aStack.append((t, True))
+                aStack.extend((d, False) for d in aDeps if d not in memo)
+                continue
+            aMtimes = [obj.mtime() for obj in aInputs if hasattr(obj, 'mtime')]
+            aMtimes.extend(memo[d] for d in aDeps if memo[d] is not None)
+            memo[t] = max(aMtimes) if len(aMtimes) > 0 else None
+        return memo[task]
+
+resolver = InputResolver()
+
+# Tasks known to be complete without checking, when kept by watch() for the parts of the graph nothing has changed in
+cacheKnownComplete = cache.BuildCache('Known complete')
+
+def isKnownComplete(task):
+    return task in cacheKnownComplete or buildstate.isComplete(task)
 
 def getAllInputTargets(aTask):
-    if len(aTask) == 0: return set()
-    setRslt = set()
-    for t in aTask:
-        setRslt |= set(flatten(t.input()))
-        setRslt |= getAllInputTargets(t._requires())
-    return setRslt
+    return resolver.getAllInputTargets(aTask)
 
 class BaseTask(lg.Task):
     prev = TaskListParameter((), significant=False, positional=False)
     logger = logger
+    checkDigest = False
+    _repr = None
 
-    #def __init__(self, *args, **kwargs):
-    #    super().__init__(*args, **kwargs)
-    #    self.objOutput = None
+    # Whether the outputs may be taken from, and put into, the output cache when run(output_cache=...) is used
+    cacheOutputs = True
 
-    # Mostly copied from the original luigi
+    # EnvCheck classes of the tools used: the task runs again when their binaries or versions change
+    envChecks = ()
+
+    # If logDir is set, the output of commands goes into a log file per task, optionally gzipped,
+    # and the latest line is shown at most once per logLive seconds
+    logDir = None
+    logCompress = False
+    logLive = None
+
+    # Resources taken while running: number of cores, memory in MB, and named tokens like {'disk-io': 1}
+    cores = 1
+    memory = 0
+    tokens = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # So that a TaskParameter created elsewhere, like dynamic dependencies from forked workers, can find this task
+        mTaskById[self.task_id] = self
+
+    # Computed only once, as it is needed in every log line
     def __repr__(self):
+        if self._repr is None:
+            self._repr = self.getRepr()
+        return self._repr
+
+    # Mostly copied from the original luigi
+    # Except that param_kwargs is used as is: get_param_values() would repr() all upstream tasks again
+    def getRepr(self):
         params = self.get_params()
-        param_values = self.get_param_values(params, [], self.param_kwargs)
 
         # Build up task id
         repr_parts = []
         param_objs = dict(params)
-        for param_name, param_value in param_values:
+        for param_name, _ in params:
+            param_value = self.param_kwargs[param_name]
             if param_objs[param_name].significant:
                 # If there is serializeShort we added, use it
                 if hasattr(param_objs[param_name], 'serializeShort'):
@@ -63,6 +168,14 @@ class BaseTask(lg.Task):
 
         return '{}({})'.format(self.get_task_family(), ', '.join(repr_parts))
 
+    @property
+    def resources(self):
+        rslt = {'cores': self.cores}
+        if self.memory > 0:
+            rslt['memory'] = self.memory
+        rslt.update(self.tokens)
+        return rslt
+
     def _requires(self):
         return flatten(self.requires()) + list(self.prev)
 
@@ -86,38 +199,143 @@ class BaseTask(lg.Task):
         """
         Return `True` if all output files exist and their modification time is newer than
         the modification time of any input file. Otherwise, return `False`.
+
+        If `checkDigest` is set, the content digests of the inputs are compared against the
+        ones recorded when the outputs were built instead, so merely touched inputs don't
+        cause a rebuild.
+
+        If the build state database is in use, a task recorded complete with nothing changed
+        since is complete right away.
         """
-        aInputs = list(getAllInputTargets([self]))
+        with trace.span('complete', 'complete', task=self):
+            return self.getStaleReason() is None
+
+    def getStaleReason(self):
+        """Return why the task has to run, or `None` if it is complete."""
+        if isKnownComplete(self):
+            reason = None
+        else:
+            reason = self.getStaleReasonByFiles()
+            if reason is None:
+                aInputs, aDeps = resolver.node(self)
+                buildstate.record(self, flatten(self.output()), aInputs, aDeps)
+        if reason is None and len(self.envChecks) > 0:
+            aPaths = [out.path for out in flatten(self.output()) if hasattr(out, 'path')]
+            if envcheck.isToolChanged(self, buildstate.getSignatures(aPaths)):
+                reason = 'changed tool'
+        if reason is not None:
+            self.forgetStreamedInputs()
+        return reason
+
+    def forgetStreamedInputs(self):
+        # What was streamed to this task last time is gone, so the producers have to stream it again
+        for d in resolver.node(self)[1]:
+            aStreamed = [out for out in flatten(d.output()) if isinstance(out, PipeTarget) and out.isStampOnly()]
+            if len(aStreamed) == 0: continue
+            for out in aStreamed:
+                out.forgetStreamed()
+            buildstate.forget(d)
+            cacheKnownComplete.invalidate(d)
+
+    def getStaleReasonByFiles(self):
         aOutputs = flatten(self.output())
 
         # First, still check the output exists, as in luigi
-        if not all((output.exists() for output in aOutputs)):
-            return False
+        for output in aOutputs:
+            if not output.exists():
+                return 'missing output {}'.format(getattr(output, 'path', output))
 
         # Collect the list of mtime from outputs. If none can be checked, then just assume they're okay
         aMtimesOutput = [output.mtime() for output in aOutputs if hasattr(output, 'mtime')]
         if len(aMtimesOutput) == 0:
-            return True
+            return None
 
-        # Collect the list of mtime from inputs. If none can be checked, then just assume they're okay
-        aMtimesInput = [obj.mtime() for obj in aInputs if hasattr(obj, 'mtime')]
-        if len(aMtimesInput) == 0:
-            return True
+        # Find the newest mtime from inputs. If none can be checked, then just assume they're okay
+        mtimeInput = resolver.newestInput(self)
+        if mtimeInput is None:
+            return None
 
         # Reaching here, all outputs exist, and both input side and output side has some mtime for comparison
-        if max(aMtimesInput) > min(aMtimesOutput):
-            return False
+        isNewer = (mtimeInput <= min(aMtimesOutput))
+        if self.checkDigest:
+            if digest.isUnchanged(self, aOutputs, getAllInputTargets([self]), isNewer):
+                return None
+            return 'changed input' if isNewer else 'newer input'
+        return None if isNewer else 'newer input'
+
+    # Where the output of commands goes: None for the terminal, or an OutputCapture into the log file of this task
+    def getCapture(self):
+        if self.logDir is None:
+            return None
+        return OutputCapture(Path(self.logDir) / '{}.log{}'.format(self.task_id, '.gz' if self.logCompress else ''),
+                self.logCompress, intervalLive=self.logLive, prefix='[{}] '.format(self), logger=self.logger)
 
-        return True
+    def logCaptureFailure(self, capture):
+        self.logger.error("Command failed, last lines of {}:\n{}".format(capture.path, capture.getTail()))
 
     # Expected to get a plumbum object
     def ex(self, chain):
         self.logger.info("RUN: {}".format(chain))
-        chain & FG
+        capture = self.getCapture()
+        if capture is None and not trace.enabled:
+            chain & FG
+            return
+        # Reap the command by itself when tracing, so that its resource usage is not mixed with that of other children
+        with capture or nullcontext(), trace.span('ex', 'command', cmd=str(chain), task=self) as span:
+            rtn, mUsage = runWithUsage(chain, capture)
+            if span is not None:
+                span.args.update(mUsage, returncode=rtn)
+        if rtn != 0:
+            if capture is not None:
+                self.logCaptureFailure(capture)
+            raise ProcessExecutionError(chain.formulate(), rtn, '' if capture is None else capture.getTail(), '')
+
+    # Run many plumbum objects concurrently, and return the exit status and time of each
+    def exMany(self, aChains, jobs=None, failFast=True):
+        with self.exPool(jobs, failFast) as pool:
+            for chain in aChains:
+                pool.add(chain)
+        return pool.aResults
+
+    # Add plumbum objects to run concurrently within the context, each with its own chdir() and withEnv()
+    # By default as many at once as the cores this task takes, which is what the scheduler has reserved for it
+    @contextmanager
+    def exPool(self, jobs=None, failFast=True):
+        capture = self.getCapture()
+        pool = CmdPool(jobs or self.resources.get('cores'), failFast, self.logger, capture, task=self)
+        yield pool
+        with capture or nullcontext():
+            try:
+                pool.run()
+            except ProcessExecutionError:
+                if capture is not None:
+                    self.logCaptureFailure(capture)
+                raise
 
 class Task(BaseTask):
     pass
 
+# A running task may change any file, so anything derived from the filesystem must be looked up again
+@BaseTask.event_handler(lg.Event.START)
+def invalidateCacheOnStart(task):
+    cache.invalidateVolatile()
+
+# The run() phase of each task, seen from the process actually running it
+@BaseTask.event_handler(lg.Event.START)
+def traceTaskStart(task):
+    if trace.enabled:
+        task._tTraceStart = time.time()
+
+@BaseTask.event_handler(lg.Event.PROCESSING_TIME)
+def traceTaskDone(task, t):
+    if trace.enabled:
+        trace.addEvent('run', 'run', task._tTraceStart, task._tTraceStart + t, task=task)
+
+@BaseTask.event_handler(lg.Event.FAILURE)
+def traceTaskFailed(task, exception):
+    if trace.enabled and hasattr(task, '_tTraceStart'):
+        trace.addEvent('run', 'run', task._tTraceStart, time.time(), task=task, failed=True)
+
 @Task.event_handler(lg.Event.START)
 def logTaskStart(task):
     logger.debug("{}{}Start {}{}".format(Fore.CYAN, Style.BRIGHT, task, Style.RESET_ALL))
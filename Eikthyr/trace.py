@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2023, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import tempfile
+import threading
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from shutil import rmtree
+
+# Only switched on within a traced run(), so that everything here costs one check otherwise
+enabled = False
+dirEvents = None
+
+# Each process appends the events it sees into its own file, as tasks may run in forked processes
+fpEvents = None
+pidEvents = None
+lockEvents = threading.Lock()
+
+NULL_SPAN = nullcontext()
+
+def addEvent(name, cat, tStart, tEnd, **args):
+    global fpEvents, pidEvents
+    if not enabled: return
+    event = {'name': name, 'cat': cat, 'ph': 'X', 'ts': tStart * 1e6, 'dur': (tEnd - tStart) * 1e6,
+            'pid': os.getpid(), 'tid': threading.get_ident() % (1<<31), 'args': args}
+    line = json.dumps(event, default=str) + '\n'
+    with lockEvents:
+        if pidEvents != os.getpid():
+            fpEvents = open(Path(dirEvents) / '{}.jsonl'.format(os.getpid()), 'a', buffering=1)
+            pidEvents = os.getpid()
+        fpEvents.write(line)
+
+class Span(object):
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.tStart = time.time()
+        return self
+
+    def __exit__(self, *args):
+        addEvent(self.name, self.cat, self.tStart, time.time(), **self.args)
+
+def span(name, cat, **args):
+    """A context to record as one event, which does nothing when not tracing."""
+    if not enabled: return NULL_SPAN
+    return Span(name, cat, args)
+
+def collect():
+    aEvents = []
+    for path in Path(dirEvents).glob('*.jsonl'):
+        with open(path) as fp:
+            aEvents.extend(json.loads(line) for line in fp if line.endswith('\n'))
+    return aEvents
+
+def getSummary(aEvents):
+    """A compact summary: the total time of each phase, and the phases of each task."""
+    mTotal = defaultdict(float)
+    mTask = defaultdict(lambda: defaultdict(float))
+    for e in aEvents:
+        mTotal[e['cat']] += e['dur'] / 1e6
+        if e['args'].get('task') is not None:
+            mTask[e['args']['task']][e['cat']] += e['dur'] / 1e6
+        if e['cat'] == 'command':
+            for k in ('utime', 'stime'):
+                mTotal['command_' + k] += e['args'].get(k, 0.0)
+    return {'total': dict(mTotal), 'tasks': {k: dict(v) for k, v in sorted(mTask.items())}}
+
+def export(path, aEvents):
+    """Write the events as a Chrome trace (viewable in Perfetto), and the summary next to it."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as fp:
+        json.dump({'traceEvents': sorted(aEvents, key=lambda e: e['ts']), 'displayTimeUnit': 'ms'}, fp)
+    with open(path.with_name(path.stem + '.summary.json'), 'w') as fp:
+        json.dump(getSummary(aEvents), fp, indent=2, sort_keys=True)
+
+def addQueueEvents(aTimeline, tBuild, fnDeps):
+    """Record how long each task waited between being ready to run and actually starting."""
+    mEnd = {task: tEnd for task, _, tEnd in aTimeline}
+    for task, tStart, _ in aTimeline:
+        tReady = max([mEnd[d] for d in fnDeps(task) if d in mEnd], default=tBuild)
+        if tStart > tReady:
+            addEvent('queue', 'queue', tReady, tStart, task=task)
+
+@contextmanager
+def scope(path):
+    """Trace everything within the context, and export the result into `path` at the end."""
+    global enabled, dirEvents, pidEvents
+    if path is None:
+        yield
+        return
+    dirEvents = tempfile.mkdtemp(prefix='eikthyr-trace-')
+    enabled = True
+    try:
+        yield
+    finally:
+        enabled = False
+        if pidEvents == os.getpid():
+            fpEvents.close()
+        pidEvents = None
+        export(path, collect())
+        rmtree(dirEvents)
+        dirEvents = None
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2023, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import select
+import struct
+from collections import defaultdict
+
+import luigi as lg
+from luigi.task import flatten
+
+from . import cache
+from .task import resolver, cacheKnownComplete
+from .specialtask import InputTask
+from .target import Target, statOrNone
+from .executor import isExternal
+from .run import run
+from .logging import logger
+
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+MASK_WATCH = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+SIZE_EVENT = struct.calcsize('iIII')
+
+class InotifyWatcher(object):
+    """
+    Watch the directories containing the paths with inotify, which is only available on Linux.
+    Paths which are directories are watched recursively, including subdirectories created later.
+    """
+
+    def __init__(self, aPaths):
+        # Only imported when really used, as it is slow to import
+        import ctypes, ctypes.util
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError("inotify is not available")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.mDir = {}
+        self.aTrees = [os.path.abspath(p) for p in aPaths]
+        setDirs = set()
+        for p in aPaths:
+            setDirs.add(getExistingDir(os.path.dirname(p)))
+        try:
+            for d in setDirs:
+                self.addWatch(d)
+            # Directories, like the sources of InputTask, are watched all the way down
+            for p in aPaths:
+                if os.path.isdir(p):
+                    self.addWatchTree(p)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def addWatch(self, d):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(d), MASK_WATCH)
+        if wd < 0:
+            raise OSError(self.ctypes.get_errno(), "inotify_add_watch failed", d)
+        self.mDir[wd] = d
+
+    def addWatchTree(self, path):
+        for d, _, _ in os.walk(path):
+            self.addWatch(d)
+
+    def isInTree(self, path):
+        return any(path == p or path.startswith(p + os.sep) for p in self.aTrees)
+
+    def wait(self, timeout=None):
+        """Return the set of paths changed, or an empty set if nothing happened within `timeout` seconds."""
+        aReady, _, _ = select.select([self.fd], [], [], timeout)
+        if len(aReady) == 0:
+            return set()
+        setChanged = set()
+        try:
+            while True:
+                buf = os.read(self.fd, 1<<16)
+                i = 0
+                while i < len(buf):
+                    wd, mask, _, size = struct.unpack_from('iIII', buf, i)
+                    name = buf[i+SIZE_EVENT:i+SIZE_EVENT+size].rstrip(b'\0')
+                    if wd in self.mDir:
+                        path = os.path.join(self.mDir[wd], os.fsdecode(name)) if name else self.mDir[wd]
+                        setChanged.add(path)
+                        # New subdirectories inside a watched tree
+                        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and self.isInTree(path):
+                            try:
+                                self.addWatchTree(path)
+                            except OSError:
+                                pass # Gone again already
+                    i += SIZE_EVENT + size
+        except BlockingIOError:
+            pass
+        return setChanged
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher(object):
+    """Compare the status of the paths every `interval` seconds."""
+
+    def __init__(self, aPaths, interval=1.0):
+        self.aPaths = list(aPaths)
+        self.interval = interval
+        self.mSig = self.getSignatures()
+
+    def getSignatures(self):
+        rslt = {}
+        for p in self.aPaths:
+            st = statOrNone(p)
+            rslt[p] = None if st is None else (st.st_size, st.st_mtime_ns)
+            if st is not None and os.path.isdir(p):
+                rslt[p] = (Target(p).mtime(),)
+        return rslt
+
+    def wait(self, timeout=None):
+        tEnd = None if timeout is None else time.time() + timeout
+        while True:
+            time.sleep(self.interval if tEnd is None else max(min(self.interval, tEnd - time.time()), 0))
+            mSig = self.getSignatures()
+            setChanged = {p for p, sig in mSig.items() if sig != self.mSig[p]}
+            self.mSig = mSig
+            if len(setChanged) > 0 or (tEnd is not None and time.time() >= tEnd):
+                return setChanged
+
+    def close(self):
+        pass
+
+def getExistingDir(path):
+    path = os.path.abspath(path)
+    while not os.path.isdir(path):
+        path = os.path.dirname(path)
+    return path
+
+def isRelated(pathA, pathB):
+    return pathA == pathB or pathA.startswith(pathB + os.sep) or pathB.startswith(pathA + os.sep)
+
+class TaskGraph(object):
+    """The whole graph under some tasks, and the files at its leaves which may be changed by hand."""
+
+    def __init__(self, tasks):
+        self.tasks = list(tasks)
+        self.aAll = []
+        self.mDependents = defaultdict(list)
+        self.mPathTasks = defaultdict(list)
+        with cache.scope():
+            for t in resolver.walk(self.tasks):
+                self.aAll.append(t)
+                aDeps = resolver.node(t)[1]
+                for d in aDeps:
+                    self.mDependents[d].append(t)
+                if len(aDeps) == 0 or isinstance(t, InputTask) or isExternal(t):
+                    for out in flatten(t.output()):
+                        if isinstance(out, Target):
+                            self.mPathTasks[os.path.abspath(out.path)].append(t)
+            # The requirements never change, so they are kept for all later builds
+            self.mNode = dict(resolver.cacheNode.data)
+
+    def getAffectedClosure(self, setChanged):
+        """Return all tasks affected by the changed paths."""
+        aStack = [t for p, aTasks in self.mPathTasks.items() if any(isRelated(p, c) for c in setChanged) for t in aTasks]
+        setAffected = set(aStack)
+        while len(aStack) > 0:
+            for t in self.mDependents[aStack.pop()]:
+                if t not in setAffected:
+                    setAffected.add(t)
+                    aStack.append(t)
+        return setAffected
+
+    def getWrittenPaths(self, aTasks):
+        """Return the output paths the tasks may write when run, i.e. unless they are only sources."""
+        return {os.path.abspath(out.path) for t in aTasks if not isinstance(t, InputTask) and not isExternal(t)
+                for out in flatten(t.output()) if isinstance(out, Target)}
+
+    def getAffectedTasks(self, setChanged):
+        """Return the most downstream tasks among all tasks affected by the changed paths."""
+        setAffected = self.getAffectedClosure(setChanged)
+        return [t for t in setAffected if not any(d in setAffected for d in self.mDependents[t])]
+
+def runLogged(tasks, **kwargs):
+    try:
+        run(tasks, **kwargs)
+        return True
+    except RuntimeError as ex:
+        logger.error("{}, waiting for changes".format(ex))
+        return False
+
+def watch(tasks, debounce=0.2, interval=1.0, polling=False, rounds=None, **kwargs):
+    """
+    Run the tasks, then keep watching the input files at the leaves of the graph, and whenever
+    they change, run again only the tasks downstream of them. Changes arriving within `debounce`
+    seconds of each other are handled together. Other arguments are passed to run().
+
+    The graph is resolved only once, and the tasks not affected by the changes are not checked again.
+    inotify is used if possible, otherwise the files are checked every `interval` seconds.
+    This goes on forever, or for `rounds` times of changes.
+    """
+    if isinstance(tasks, lg.Task):
+        tasks = (tasks,)
+    graph = TaskGraph(tasks)
+    # Everything is complete after a successful build; after that, only what the changes affect is checked again
+    with cache.keep(resolver.cacheNode, graph.mNode):
+        setComplete = set(graph.aAll) if runLogged(graph.tasks, **kwargs) else set()
+
+    watcher = None
+    if not polling:
+        try:
+            watcher = InotifyWatcher(graph.mPathTasks)
+        except OSError as ex:
+            logger.warning("Falling back to polling: {}".format(ex))
+    if watcher is None:
+        watcher = PollingWatcher(graph.mPathTasks, interval)
+    logger.info("Watching {} paths".format(len(graph.mPathTasks)))
+
+    try:
+        nRound = 0
+        setPending = set()
+        while rounds is None or nRound < rounds:
+            setChanged = setPending or watcher.wait()
+            setPending = set()
+            while True:
+                setMore = watcher.wait(debounce)
+                if len(setMore) == 0: break
+                setChanged |= setMore
+            aTasks = graph.getAffectedTasks(setChanged)
+            if len(aTasks) == 0: continue
+            nRound += 1
+            logger.info("Changed: {}".format(', '.join(sorted(setChanged))))
+            setAffected = graph.getAffectedClosure(setChanged)
+            setComplete -= setAffected
+            with cache.keep(resolver.cacheNode, graph.mNode), cache.keep(cacheKnownComplete, dict.fromkeys(setComplete, True)):
+                if runLogged(aTasks, **kwargs):
+                    setComplete = set(graph.aAll)
+            # Only what the build itself has written is not a change; anything else changed meanwhile goes to the next round
+            setWritten = graph.getWrittenPaths(setAffected)
+            setPending = {p for p in watcher.wait(0) if p not in setWritten}
+    finally:
+        watcher.close()
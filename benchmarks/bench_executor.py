@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2023, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Wall time of running many tiny tasks with each executor
+# Usage: python benchmarks/bench_executor.py [number of tasks] [workers ...]
+
+import sys
+import time
+import logging
+from pathlib import Path
+from shutil import rmtree
+
+import Eikthyr as eik
+
+class BenchLeaf(eik.Task):
+    out = eik.PathParameter()
+
+    def run(self):
+        with self.output().fpWrite() as fpw:
+            fpw.write('x')
+
+class BenchJoin(eik.Task):
+    src = eik.TaskListParameter()
+    out = eik.PathParameter()
+
+    def run(self):
+        with self.output().fpWrite() as fpw:
+            fpw.write(str(len(self.src)))
+
+def main(nTasks, aWorkers):
+    eik.logger.setLevel(logging.WARNING)
+    for workers in aWorkers:
+        for executor in ('luigi', 'local', 'threads'):
+            rmtree('bench', ignore_errors=True)
+            aLeaves = [BenchLeaf('bench/{}.txt'.format(i)) for i in range(nTasks)]
+            t = BenchJoin(aLeaves, 'bench/join.txt')
+            t0 = time.perf_counter()
+            eik.run(t, print_summary=False, workers=workers, executor=executor)
+            tElapsed = time.perf_counter() - t0
+            print('tasks={:<6d} workers={:<3d} executor={:<8s} total={:.3f}s per_task={:.2f}ms'.format(
+                nTasks + 1, workers, executor, tElapsed, tElapsed / (nTasks + 1) * 1e3))
+    rmtree('bench', ignore_errors=True)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500, [int(a) for a in sys.argv[2:]] or [1, 4])
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2023, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Startup time of scripts using a few, or all, of Eikthyr, each in a fresh interpreter
+# Usage: python benchmarks/bench_import.py [repeats]
+
+import sys
+import time
+import statistics
+import subprocess
+
+mScripts = {
+    'python only': 'pass',
+    'import Eikthyr': 'import Eikthyr',
+    'Path': 'from Eikthyr import Path',
+    'cmdfmt': 'from Eikthyr import cmdfmt',
+    'Task': 'from Eikthyr import Task',
+    'everything': 'from Eikthyr import *',
+    }
+
+def measure(code, nRepeat):
+    aTimes = []
+    for _ in range(nRepeat):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True)
+        aTimes.append(time.perf_counter() - t0)
+    return statistics.median(aTimes), min(aTimes)
+
+def main(nRepeat):
+    for name, code in mScripts.items():
+        tMedian, tMin = measure(code, nRepeat)
+        print('{:<16s} median={:.1f}ms min={:.1f}ms'.format(name, tMedian * 1e3, tMin * 1e3))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2023, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Overhead of Eikthyr as task graphs grow, on synthetic graphs of several shapes:
+# instantiation, task_id size, complete() of an up-to-date graph, run() per task, and peak memory.
+# Each case runs in a fresh interpreter in a scratch directory, so that the peak memory is its own.
+#
+# Usage: python benchmarks/bench_scaling.py [-o results.json] [--baseline old.json] [--executor luigi local] [shape=size ...]
+# The default sizes take several minutes with the luigi executor, whose scheduling grows faster than linearly.
+# With --baseline, each metric is compared to the old results, and the exit code is 1 if any got
+# slower or bigger by more than --threshold.
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+from pathlib import Path
+from shutil import rmtree
+
+import Eikthyr as eik
+from Eikthyr import cache
+from Eikthyr.task import resolver
+
+mSizesDefault = {'chain': 1000, 'fanin': 10000, 'diamond': 500, 'inputs': 10000}
+
+# Metrics where bigger is worse, compared against the baseline
+aMetrics = ['instantiate_us_per_task', 'task_id_len', 'complete_us_per_task', 'run_ms_per_task', 'noop_run_ms_per_task', 'peak_rss_mb']
+
+class BenchLeaf(eik.Task):
+    out = eik.PathParameter()
+
+    def run(self):
+        with self.output().fpWrite() as fpw:
+            fpw.write('x')
+
+class BenchChain(eik.Task):
+    src = eik.TaskParameter()
+    out = eik.PathParameter()
+
+    def run(self):
+        with self.output().fpWrite() as fpw:
+            fpw.write('x')
+
+class BenchJoin(eik.Task):
+    src = eik.TaskListParameter()
+    out = eik.PathParameter()
+
+    def run(self):
+        with self.output().fpWrite() as fpw:
+            fpw.write(str(len(self.src)))
+
+def makeChain(n):
+    t = BenchLeaf('out/0')
+    for i in range(1, n):
+        t = BenchChain(t, 'out/{}'.format(i))
+    return t
+
+def makeFanin(n):
+    return BenchJoin([BenchLeaf('out/{}'.format(i)) for i in range(n - 1)], 'out/join')
+
+def makeDiamond(n):
+    # Each layer is two tasks on the previous join, joined again
+    t = BenchLeaf('out/0')
+    for i in range(1, (n + 2) // 3):
+        t = BenchJoin([BenchChain(t, 'out/{}a'.format(i)), BenchChain(t, 'out/{}b'.format(i))], 'out/{}'.format(i))
+    return t
+
+def makeInputs(n):
+    return BenchJoin([eik.InputTask('in/{}'.format(i)) for i in range(n - 1)], 'out/join')
+
+mShapes = {'chain': makeChain, 'fanin': makeFanin, 'diamond': makeDiamond, 'inputs': makeInputs}
+
+def measureOne(shape, n, executor):
+    """Measure one case in this process, which should be a fresh one, within the current directory."""
+    eik.logger.setLevel(logging.WARNING)
+    if shape == 'inputs':
+        Path('in').mkdir()
+        for i in range(n - 1):
+            Path('in/{}'.format(i)).write_text('x')
+
+    t0 = time.perf_counter()
+    root = mShapes[shape](n)
+    tInstantiate = time.perf_counter() - t0
+    with cache.scope():
+        aTasks = list(resolver.walk([root]))
+    nTasks = len(aTasks)
+
+    t0 = time.perf_counter()
+    eik.run(root, print_summary=False, executor=executor)
+    tRun = time.perf_counter() - t0
+
+    # Checking an up-to-date graph, as done before every build
+    t0 = time.perf_counter()
+    with cache.scope():
+        assert all(t.complete() for t in aTasks)
+    tComplete = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    eik.run(root, print_summary=False, executor=executor)
+    tNoop = time.perf_counter() - t0
+
+    return {
+        'shape': shape,
+        'size': n,
+        'tasks': nTasks,
+        'executor': executor,
+        'instantiate_us_per_task': tInstantiate / nTasks * 1e6,
+        'task_id_len': len(root.task_id),
+        'complete_us_per_task': tComplete / nTasks * 1e6,
+        'run_ms_per_task': tRun / nTasks * 1e3,
+        'noop_run_ms_per_task': tNoop / nTasks * 1e3,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+
+def measure(shape, n, executor):
+    """Measure one case in a fresh interpreter in a scratch directory."""
+    dirWork = tempfile.mkdtemp(prefix='eikthyr-bench-')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(Path(__file__).resolve().parent.parent), os.getenv('PYTHONPATH', '')]))
+    try:
+        proc = subprocess.run([sys.executable, str(Path(__file__).resolve()), '--one', shape, str(n), '--executor', executor],
+                cwd=dirWork, env=env, check=True, stdout=subprocess.PIPE)
+    finally:
+        rmtree(dirWork, ignore_errors=True)
+    return json.loads(proc.stdout.decode().strip().split('\n')[-1])
+
+def compare(aResults, aBaseline, threshold):
+    """Print the ratio of each metric to the baseline, and return the number of regressions."""
+    mBaseline = {(r['shape'], r['size'], r['executor']): r for r in aBaseline}
+    nRegression = 0
+    for r in aResults:
+        old = mBaseline.get((r['shape'], r['size'], r['executor']))
+        if old is None: continue
+        for metric in aMetrics:
+            if not old.get(metric): continue
+            ratio = r[metric] / old[metric]
+            isRegression = ratio > threshold
+            nRegression += isRegression
+            print('{:<8s} {:<6d} {:<7s} {:<24s} {:10.2f} -> {:10.2f} x{:.2f}{}'.format(
+                r['shape'], r['size'], r['executor'], metric, old[metric], r[metric], ratio, '  REGRESSION' if isRegression else ''))
+    return nRegression
+
+def main():
+    parser = argparse.ArgumentParser(description='Scaling benchmarks of Eikthyr on synthetic task graphs')
+    parser.add_argument('cases', nargs='*', help='shape=size, with shapes {}'.format(', '.join(mShapes)))
+    parser.add_argument('-o', '--output', default='bench_scaling.json', help='where to write the results')
+    parser.add_argument('--baseline', help='results from before to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='ratio to the baseline counted as a regression')
+    parser.add_argument('--executor', nargs='+', default=['luigi', 'local'], choices=['luigi', 'local', 'threads'],
+            help='executors to measure run() with, each measured and compared separately')
+    parser.add_argument('--one', nargs=2, metavar=('SHAPE', 'SIZE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one is not None:
+        print(json.dumps(measureOne(args.one[0], int(args.one[1]), args.executor[0])))
+        return 0
+
+    mSizes = dict(mSizesDefault)
+    if len(args.cases) > 0:
+        mSizes = dict((case.split('=')[0], int(case.split('=')[1])) for case in args.cases)
+    for shape in mSizes:
+        if shape not in mShapes:
+            parser.error("Unknown shape '{}'".format(shape))
+
+    aResults = []
+    for (shape, n), executor in ((case, executor) for case in mSizes.items() for executor in args.executor):
+        r = measure(shape, n, executor)
+        aResults.append(r)
+        print('{shape:<8s} {executor:<7s} tasks={tasks:<6d} instantiate={instantiate_us_per_task:.1f}us task_id_len={task_id_len} '
+                'complete={complete_us_per_task:.1f}us run={run_ms_per_task:.2f}ms noop_run={noop_run_ms_per_task:.3f}ms '
+                'peak_rss={peak_rss_mb:.0f}MB'.format(**r))
+
+    with open(args.output, 'w') as fpw:
+        json.dump({
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': aResults,
+            }, fpw, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as fp:
+            nRegression = compare(aResults, json.load(fp)['results'], args.threshold)
+        if nRegression > 0:
+            print('{} regressions beyond x{}'.format(nRegression, args.threshold))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
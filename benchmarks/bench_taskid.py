@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2023, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Instantiation time and task_id size of deep task chains
+# Usage: python benchmarks/bench_taskid.py [depth ...]
+
+import sys
+import time
+
+import Eikthyr as eik
+
+class BenchRoot(eik.Task):
+    out = eik.PathParameter()
+
+class BenchChain(eik.Task):
+    src = eik.TaskParameter()
+    out = eik.PathParameter()
+
+def main(aDepths):
+    for depth in aDepths:
+        t0 = time.perf_counter()
+        t = BenchRoot('bench/0.txt')
+        for i in range(1, depth):
+            t = BenchChain(t, 'bench/{}.txt'.format(i))
+        tElapsed = time.perf_counter() - t0
+        print('depth={:<8d} total={:.3f}s per_task={:.1f}us task_id_len={} src_param_len={}'.format(
+            depth, tElapsed, tElapsed / depth * 1e6, len(t.task_id), len(t.to_str_params()['src'])))
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or [100, 1000, 10000])
@@ -14,12 +14,17 @@
 # limitations under the License.
 
 import os
+import gzip
+import time
 from pathlib import Path
 
+import pytest
 import hypothesis.strategies as st
 from hypothesis import given, example
+from .common import TestFieldForFile
 
 import Eikthyr as eik
+from Eikthyr.cmd import CmdPool, OutputCapture
 import plumbum
 from plumbum import local
 
@@ -49,3 +54,48 @@ def test_withenv(val):
 
 def test_cmdfmt():
     assert eik.cmdfmt(['ls', '{}/'], 'tests')
+
+def test_cmdPool():
+    with TestFieldForFile() as _:
+        pool = CmdPool(jobs=4)
+        for i in range(8):
+            with eik.mkcd(str(i)), eik.withEnv(EIKTEST_TEST01=str(i)):
+                pool.add(local['sh']['-c', 'echo $EIKTEST_TEST01 > out.txt'])
+        aResults = pool.run()
+        assert [r.returncode for r in aResults] == [0]*8
+        for i in range(8):
+            assert Path(str(i), 'out.txt').read_text() == '{}\n'.format(i)
+
+def test_cmdPoolFailFast():
+    pool = CmdPool(jobs=2)
+    pool.add(local['false'])
+    pool.add(local['sleep']['10'])
+    for i in range(4):
+        pool.add(local['true'])
+    t0 = time.time()
+    with pytest.raises(plumbum.commands.ProcessExecutionError):
+        pool.run()
+    assert time.time() - t0 < 5
+    assert pool.aResults[0].returncode == 1
+    assert pool.aResults[-1].returncode is None
+
+def test_outputCapture():
+    with TestFieldForFile() as _:
+        with OutputCapture('logs/000.log', nTail=2) as capture:
+            rtn = capture.run(local['sh']['-c', 'for i in 1 2 3 4; do echo $i; done; echo err >&2'])
+            assert rtn == 0
+            assert capture.getTail() == '4\nerr\n'
+            # Both ends of a pipeline are captured
+            capture.run(local['sh']['-c', 'echo 5; echo err >&2'] | local['cat'])
+        assert Path('logs/000.log').read_text().startswith('1\n2\n3\n4\nerr\n')
+        assert sorted(Path('logs/000.log').read_text().splitlines()[5:]) == ['5', 'err']
+
+def test_outputCaptureCompressed():
+    with TestFieldForFile() as _:
+        with OutputCapture('000.log.gz', compress=True) as capture:
+            pool = CmdPool(jobs=4, capture=capture)
+            for i in range(8):
+                pool.add(local['sh']['-c', 'for i in 1 2 3; do echo {}; done'.format(i)])
+            pool.run()
+        with gzip.open('000.log.gz', 'rt') as fp:
+            assert sorted(fp.read().splitlines()) == sorted(str(i) for i in range(8) for _ in range(3))
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2023, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import json
+from pathlib import Path
+
+from .common import TestFieldForFile
+
+from Eikthyr import envcheck
+from Eikthyr.envcheck import EnvCheck
+from Eikthyr.cmd import withEnv
+from Eikthyr.target import Target
+from Eikthyr.task import Task
+from Eikthyr.plan import plan
+from Eikthyr.run import run
+
+# Put all luigi imports after Eikthyr to suppress annoying warnings
+import luigi as lg
+
+class EnvTool(EnvCheck):
+    cmd = 'eikthyr-test-tool'
+    versionArgs = ('--version',)
+
+class EnvSh(EnvCheck):
+    cmd = 'sh'
+
+class EnvShMore(EnvSh):
+    cmd = ('ls', '-l')
+
+class TaskTool(Task):
+    envChecks = (EnvTool,)
+
+    def output(self):
+        return Target('out.txt')
+
+    def run(self):
+        with self.output().fpWrite() as fpw:
+            fpw.write('done\n')
+
+def writeTool(version):
+    Path('bin').mkdir(exist_ok=True)
+    Path('bin/eikthyr-test-tool').write_text('#!/bin/sh\necho "tool {}"\n'.format(version))
+    os.chmod('bin/eikthyr-test-tool', 0o755)
+
+def test_envCheckPerSubclass():
+    assert EnvSh() is EnvSh()
+    assert type(EnvShMore()) is EnvShMore
+    assert EnvShMore() is EnvShMore()
+
+def test_envCheckFingerprint():
+    with TestFieldForFile() as _:
+        writeTool('1.0')
+        with withEnv(PATH='{}:{}'.format(os.path.abspath('bin'), os.environ['PATH'])):
+            t = TaskTool()
+            run(t)
+            mFile = json.loads(envcheck.getFingerprintFile().read_text())
+            aEntries = [m['eikthyr-test-tool'] for m in mFile.values() if 'eikthyr-test-tool' in m]
+            assert aEntries[0]['version'] == 'tool 1.0'
+            assert plan(t) == []
+
+            writeTool('2.0.1')
+            assert plan(t) == [(t, 'changed tool')]
+            run(t)
+            assert plan(t) == []
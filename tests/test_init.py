@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2023, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import sys
+import subprocess
+from pathlib import Path
+
+from .common import TestFieldForFile
+
+def runPython(code):
+    env = dict(os.environ, PYTHONPATH=str(Path(__file__).resolve().parent.parent))
+    return subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE, env=env).stdout.decode().split()
+
+def test_importLazily():
+    assert runPython("import sys, Eikthyr; print('luigi' in sys.modules, 'plumbum' in sys.modules)") == ['False', 'False']
+    assert runPython("import sys; from Eikthyr import cmdfmt; print('luigi' in sys.modules)") == ['False']
+
+def test_importShadowedNames():
+    # The submodules must not hide the functions of the same name, whatever gets imported first
+    assert runPython("import Eikthyr.watch, Eikthyr as eik; print(eik.run.__name__, eik.plan.__name__, eik.watch.__name__)") == ['run', 'plan', 'watch']
+    assert runPython("from Eikthyr import *; print(callable(run), type(cmd).__name__, Task.__name__)") == ['True', 'MachineCmd', 'Task']
+
+def test_importAll():
+    # Internal modules don't leak into the namespace of scripts
+    assert runPython("from Eikthyr import *; print('cache' in dir(), 'state' in dir(), 'trace' in dir())") == ['False', 'False', 'False']
+    assert runPython("from Eikthyr import *; print({'param', 'target', 'task', 'envcheck', 'logging'} <= set(dir()))") == ['True']
+    assert runPython("import Eikthyr; print(Eikthyr.cache.__name__)") == ['Eikthyr.cache']
+    assert runPython("import sys; from Eikthyr import *; print('ctypes.util' in sys.modules)") == ['False']
+
+def test_loadEnvDeferred():
+    with TestFieldForFile() as _:
+        with open('.env', 'w') as fpw:
+            fpw.write('EIKTHYR_TEST_DOTENV=yes\n')
+        code = "import os, Eikthyr; print(os.getenv('EIKTHYR_TEST_DOTENV')); Eikthyr.Task; print(os.getenv('EIKTHYR_TEST_DOTENV'))"
+        assert runPython(code) == ['None', 'yes']
+
+        # Also before luigi is imported through a submodule
+        with open('.env', 'w') as fpw:
+            fpw.write('LUIGI_CONFIG_PATH=test.cfg\n')
+        with open('test.cfg', 'w') as fpw:
+            fpw.write('[eikthyr_test]\nvalue=yes\n')
+        code = "import Eikthyr.task, luigi; print(luigi.configuration.get_config().get('eikthyr_test', 'value', 'no'))"
+        assert runPython(code) == ['yes']
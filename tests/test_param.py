@@ -13,12 +13,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gc
 from pathlib import Path
 
 import hypothesis.strategies as st
 from hypothesis import given, example
 
-from Eikthyr.param import PathParameter
+from Eikthyr.param import PathParameter, TaskParameter, TaskListParameter, mTaskById
+from Eikthyr.task import BaseTask
 import luigi as lg
 
 class TaskForPath(lg.Task):
@@ -47,3 +49,39 @@ def test_pathparameterRestore(p):
     t1 = TaskForPath(p)
     pReal, val = getParameterObjAndVal(t1, 'p')
     assert Path(pReal.serialize(pReal.parse(pReal.serialize(val)))) == Path(p)
+
+class TaskForRoot(BaseTask):
+    pass
+
+class TaskForChain(BaseTask):
+    src = TaskParameter()
+    srcs = TaskListParameter(())
+
+def test_taskParameterRestore():
+    t0 = TaskForRoot()
+    t1 = TaskForChain(t0, [t0])
+    pReal, val = getParameterObjAndVal(t1, 'src')
+    assert pReal.parse(pReal.serialize(val)) is t0
+    pReal, val = getParameterObjAndVal(t1, 'srcs')
+    assert list(pReal.parse(pReal.serialize(val))) == [t0]
+    assert TaskForChain.from_str_params(t1.to_str_params()) is t1
+
+def test_taskParameterIdSize():
+    t = TaskForRoot()
+    for i in range(1000):
+        t = TaskForChain(t, [t])
+        if i == 10:
+            nLen = len(t.to_str_params()['src'])
+    # The identity doesn't grow with the ancestry
+    assert len(t.to_str_params()['src']) == nLen
+    assert t.task_id != TaskForChain(t.src, [t.src, t.src]).task_id
+
+def test_taskParameterForgotten():
+    t = TaskForChain(TaskForRoot(), [])
+    taskId = t.src.task_id
+    assert taskId in mTaskById
+    # Not kept alive just for being known by id
+    del t
+    lg.task_register.Register.clear_instance_cache()
+    gc.collect()
+    assert taskId not in mTaskById
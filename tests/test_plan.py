@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2023, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import sqlite3
+from pathlib import Path
+
+from .common import TestFieldForFile
+from .test_task import getStdTaskChain
+from .test_target import TaskPipeProducer, TaskPipeConsumer
+
+from Eikthyr.plan import plan, formatPlan
+from Eikthyr.run import run
+from Eikthyr.state import getStateDir
+
+# Put all luigi imports after Eikthyr to suppress annoying warnings
+import luigi as lg
+
+def test_planMissing():
+    with TestFieldForFile() as _:
+        tA, tB, tC = getStdTaskChain()
+        aPlan = plan(tC)
+        assert aPlan == [(tA, 'missing output a.txt'), (tB, 'missing output b.txt'), (tC, 'missing output c.txt')]
+        assert not Path('a.txt').exists()
+
+def test_planNewerInput():
+    with TestFieldForFile() as _:
+        tA, tB, tC = getStdTaskChain()
+        run(tC)
+        assert plan(tC) == []
+        t = os.stat('c.txt').st_mtime
+        os.utime('a.txt', (t + 10, t + 10))
+        assert plan(tC) == [(tB, 'newer input'), (tC, 'newer input')]
+        aLines = formatPlan(plan(tC), 'json').splitlines()
+        assert [json.loads(line)['task'] for line in aLines] == [tB.task_id, tC.task_id]
+
+def dumpState():
+    with sqlite3.connect(str(getStateDir() / 'state.sqlite')) as conn:
+        return list(conn.iterdump())
+
+def test_planReadOnly():
+    with TestFieldForFile() as _:
+        tA, tB, tC = getStdTaskChain()
+        run(tC, build_state=True)
+        aDump = dumpState()
+        # Would record the build state and the digests of the complete tasks if it could
+        assert plan(tC, check_digest=True, build_state=True) == []
+        assert dumpState() == aDump
+
+        t = TaskPipeConsumer(TaskPipeProducer('a2.txt'), 'b2.txt')
+        run(t, workers=2, executor='threads')
+        Path('b2.txt').unlink()
+        aDump = dumpState()
+        assert plan(t, build_state=True) == [(t.src, 'missing output a2.txt'), (t, 'missing output b2.txt')]
+        assert Path('.a2.txt.streamed').exists()
+        assert dumpState() == aDump
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2023, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from pathlib import Path
+
+import pytest
+from plumbum import local
+from .common import TestFieldForFile
+
+from Eikthyr.param import PathParameter, TaskParameter
+from Eikthyr.specialtask import InputTask
+from Eikthyr.shard import ShardTask, getBoundaries
+from Eikthyr.run import run
+
+# Put all luigi imports after Eikthyr to suppress annoying warnings
+import luigi as lg
+
+class TaskUpper(ShardTask):
+    src = TaskParameter()
+    out = PathParameter()
+    nShard = 4
+
+    def mapShard(self, pathIn, pathOut):
+        return (local['tr']['a-z', 'A-Z'] < pathIn) > pathOut
+
+def test_boundaries():
+    with TestFieldForFile() as _:
+        Path('a.txt').write_text(''.join('line{}\n'.format(i) for i in range(10)))
+        aOffsets = getBoundaries('a.txt', 3, 'lines')
+        buf = Path('a.txt').read_bytes()
+        assert [buf[aOffsets[i]:aOffsets[i+1]].count(b'\n') for i in range(3)] == [3, 3, 4]
+        aOffsets = getBoundaries('a.txt', 3, 'bytes')
+        assert aOffsets[0] == 0 and aOffsets[-1] == len(buf)
+        assert all(buf[o-1:o] == b'\n' for o in aOffsets[1:])
+        assert getBoundaries('a.txt', 20, 'lines')[-1] == len(buf)
+
+@pytest.mark.parametrize('executor', ['luigi', 'local'])
+def test_shardTask(executor):
+    with TestFieldForFile() as _:
+        aLines = ['line{}\n'.format(i) for i in range(100)]
+        Path('a.txt').write_text(''.join(aLines))
+        t = TaskUpper(InputTask('a.txt'), 'b.txt')
+        run(t, workers=2, executor=executor)
+        assert Path('b.txt').read_text() == ''.join(aLines).upper()
+
+        aMtimes = [os.stat(t.getShardOutput(i)).st_mtime_ns for i in range(4)]
+        aLines[60] = 'changed\n'
+        Path('a.txt').write_text(''.join(aLines))
+        run(t, workers=2, executor=executor)
+        assert Path('b.txt').read_text() == ''.join(aLines).upper()
+        aChanged = [os.stat(t.getShardOutput(i)).st_mtime_ns != aMtimes[i] for i in range(4)]
+        assert aChanged == [False, False, True, False]
+
+def test_shardTaskFewerShards():
+    with TestFieldForFile() as _:
+        aLines = ['line{}\n'.format(i) for i in range(100)]
+        Path('a.txt').write_text(''.join(aLines))
+        t = TaskUpper(InputTask('a.txt'), 'b.txt')
+        run(t)
+        aLines[0] = 'changed\n'
+        Path('a.txt').write_text(''.join(aLines))
+        TaskUpper.nShard = 2
+        try:
+            run(t)
+        finally:
+            TaskUpper.nShard = 4
+        assert Path('b.txt').read_text() == ''.join(aLines).upper()
+        assert sorted(p.name for p in t.getShardDir().iterdir()) == ['in-00000', 'in-00001', 'index.json', 'out-00000', 'out-00001']
+
+def test_shardTaskAbstract():
+    class TaskNoMap(ShardTask):
+        src = TaskParameter()
+        out = PathParameter()
+
+    with pytest.raises(TypeError):
+        TaskNoMap(InputTask('a.txt'), 'b.txt')
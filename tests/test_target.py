@@ -15,13 +15,23 @@
 
 import os
 import time
+import errno
 from pathlib import Path
 
+import pytest
+from plumbum import local
 import hypothesis.strategies as st
 from hypothesis import given, example
 from .common import TestFieldForFile
 
-from Eikthyr.target import Target, BinaryTarget
+from Eikthyr import cache, outputcache
+from Eikthyr.target import Target, BinaryTarget, PipeTarget, CompressedTarget, statCache, cacheTreeMtime, cleanTrash, moveToTrash, getTrashRecordDir, PREFIX_TRASH
+from Eikthyr.task import Task
+from Eikthyr.param import PathParameter, TaskParameter
+from Eikthyr.run import run
+
+# Put all luigi imports after Eikthyr to suppress annoying warnings
+import luigi as lg
 
 @given(content=st.text())
 def test_writeTextFile(content):
@@ -75,3 +85,262 @@ def test_mtime():
         # Check mtime method matches file modification time
         assert tgt.mtime() == mtimeUpdated
         assert tgt.mtime() != mtimeInitial
+
+def test_statCache():
+    with TestFieldForFile() as _, cache.scope():
+        tgt = Target("000")
+        assert not tgt.exists()
+        with tgt.fpWrite() as fpw:
+            fpw.write("123")
+        # Write-through: the new file is seen without another stat
+        nMisses = statCache.misses
+        assert tgt.exists()
+        mtimeInitial = tgt.mtime()
+        assert statCache.misses == nMisses
+        assert statCache.hits >= 2
+
+        time.sleep(0.01)
+        with tgt.pathWrite() as fw:
+            Path(fw).write_text("456")
+        assert tgt.mtime() == os.path.getmtime(tgt.path)
+        assert tgt.mtime() != mtimeInitial
+
+def test_statCacheOutsideBuild():
+    with TestFieldForFile() as _:
+        tgt = Target("000")
+        assert not tgt.exists()
+        Path("000").write_text("123")
+        assert tgt.exists()
+
+def test_statCacheOptOut():
+    with TestFieldForFile() as _:
+        statCache.enabled = False
+        try:
+            with cache.scope():
+                tgt = Target("000")
+                assert not tgt.exists()
+                Path("000").write_text("123")
+                assert tgt.exists()
+        finally:
+            statCache.enabled = True
+
+def test_statCachePrefetch():
+    with TestFieldForFile() as _, cache.scope():
+        Path("000").write_text("123")
+        assert statCache.prefetch(["000", "001", "000"]) == 2
+        nMisses = statCache.misses
+        assert Target("000").exists()
+        assert not Target("001").exists()
+        assert statCache.misses == nMisses
+        # Under a file rather than a directory
+        assert statCache.prefetch(["000/a.txt"]) == 1
+        assert not Target("000/a.txt").exists()
+
+def test_digest():
+    with TestFieldForFile() as _:
+        tgt = Target("000")
+        with tgt.fpWrite() as fpw:
+            fpw.write("123")
+        d = tgt.digest()
+        assert d == '202cb962ac59075b964b07152d234b70'
+        # Identical content gives the same digest, even for a different file
+        Path("001").write_text("123")
+        assert Target("001").digest() == d
+
+        tgtDir = Target("dir")
+        with tgtDir.pathWrite() as fw:
+            Path(fw).mkdir()
+            (Path(fw) / "000").write_text("123")
+        dDir = tgtDir.digest()
+        (Path("dir") / "000").write_text("456")
+        assert tgtDir.digest() != dDir
+
+def test_mtimeDir():
+    with TestFieldForFile() as _:
+        tgt = Target("000")
+        with tgt.pathWrite() as fw:
+            (Path(fw) / "a" / "b").mkdir(parents=True)
+            (Path(fw) / "a" / "b" / "c.txt").write_text("123")
+            (Path(fw) / "a" / "d.log").write_text("123")
+        os.utime("000/a/b/c.txt", (1000, 1000))
+        os.utime("000/a/d.log", (1000, 1000))
+        for p in ("000/a/b", "000/a", "000"):
+            os.utime(p, (500, 500))
+        assert tgt.mtime() == 1000
+
+        # A file rewritten deep inside is noticed
+        os.utime("000/a/b/c.txt", (2000, 2000))
+        assert tgt.mtime() == 2000
+        assert Target("000", mtimeGlob="*.log").mtime() == 1000
+        assert Target("000", mtimeDepth=2).mtime() == 1000
+        assert Target("000", mtimeDepth=0).mtime() == 500
+
+def test_mtimeDirCached():
+    with TestFieldForFile() as _, cache.scope():
+        Path("000").mkdir()
+        Path("000/a.txt").write_text("123")
+        os.utime("000/a.txt", (1000, 1000))
+        tgt = Target("000")
+        mtime = tgt.mtime()
+        os.utime("000/a.txt", (2000, 2000))
+        assert tgt.mtime() == mtime
+        assert cacheTreeMtime.hits == 1
+
+class TaskPipeProducer(Task):
+    out = PathParameter()
+    isFailing = lg.BoolParameter(False)
+
+    def output(self):
+        return PipeTarget(self.out)
+
+    def run(self):
+        with self.output().fpWrite() as fpw:
+            for i in range(10000):
+                fpw.write('line{}\n'.format(i))
+            if self.isFailing:
+                raise RuntimeError("Failing")
+
+class TaskPipeConsumer(Task):
+    src = TaskParameter()
+    out = PathParameter()
+
+    def run(self):
+        with self.input().open('r') as fp:
+            n = sum(1 for _ in fp)
+        with self.output().fpWrite() as fpw:
+            fpw.write(str(n))
+
+@pytest.mark.parametrize('executor,workers,isPiped', [('luigi', 2, False), ('local', 1, False), ('local', 2, True), ('threads', 2, True)])
+def test_pipeTarget(executor, workers, isPiped):
+    with TestFieldForFile() as _:
+        t = TaskPipeConsumer(TaskPipeProducer('a.txt'), 'b.txt')
+        run(t, workers=workers, executor=executor)
+        assert Path('b.txt').read_text() == '10000'
+        assert Path('a.txt').exists() != isPiped
+        # Nothing to do again, even though the piped one is not on disk
+        assert t.complete()
+        mtime = Path('b.txt').stat().st_mtime_ns
+        run(t, workers=workers, executor=executor)
+        run(t, executor='luigi')
+        assert Path('b.txt').stat().st_mtime_ns == mtime
+        # Only the consumer is stale, but what it read is gone
+        Path('b.txt').unlink()
+        run(t, workers=workers, executor=executor)
+        assert Path('b.txt').read_text() == '10000'
+        Path('b.txt').unlink()
+        run(t, executor='luigi')
+        assert Path('b.txt').read_text() == '10000'
+        with pytest.raises(RuntimeError):
+            run(TaskPipeConsumer(TaskPipeProducer('c.txt', True), 'd.txt'), workers=workers, executor=executor)
+        assert not Path('d.txt').exists()
+
+@pytest.mark.parametrize('executor,workers,isPiped', [('luigi', 2, False), ('threads', 2, True)])
+def test_pipeTargetOutputCache(executor, workers, isPiped):
+    with TestFieldForFile() as _:
+        t = TaskPipeConsumer(TaskPipeProducer('a.txt'), 'b.txt')
+        run(t, workers=workers, executor=executor, output_cache='cache')
+        assert Path('b.txt').read_text() == '10000'
+        # Neither end of a pipe goes into the cache
+        assert outputcache.stats[:] == ([0, 2, 2] if not isPiped else [0, 0, 0])
+
+@pytest.mark.parametrize('ext', ['.gz', '.zst'])
+def test_compressedTarget(ext):
+    with TestFieldForFile() as _:
+        content = ''.join('line{}\n'.format(i) for i in range(10000))
+        tgt = CompressedTarget('a.txt' + ext, threads=2)
+        with tgt.fpWrite() as fpw:
+            fpw.write(content)
+        assert Path('a.txt' + ext).stat().st_size < len(content) / 2
+        with tgt.open('r') as fp:
+            assert fp.read() == content
+
+        tgt = CompressedTarget('b.txt' + ext)
+        with tgt.pathWrite() as pathOut:
+            (local['seq'][1, 10000] > pathOut)()
+        with tgt.open('r') as fp:
+            assert fp.read() == ''.join('{}\n'.format(i) for i in range(1, 10001))
+        with CompressedTarget('d.txt' + ext).pathWrite() as pathOut:
+            assert os.path.basename(pathOut) == 'd.txt'
+
+        with pytest.raises(RuntimeError):
+            with CompressedTarget('c.txt' + ext).pathWrite() as pathOut:
+                raise RuntimeError()
+        assert not Path('c.txt' + ext).exists()
+
+def test_binaryMmap():
+    with TestFieldForFile() as _:
+        tgt = BinaryTarget('a.bin')
+        with tgt.mmapWrite(1<<20) as mm:
+            mm[0:4] = b'head'
+            mm[-4:] = b'tail'
+            assert not Path('a.bin').exists()
+        assert Path('a.bin').stat().st_size == 1<<20
+        with tgt.mmapRead() as mm:
+            assert mm[0:4] == b'head' and mm[-4:] == b'tail'
+            with memoryview(mm) as view:
+                assert view[4:8] == b'\0\0\0\0'
+
+        with pytest.raises(RuntimeError):
+            with BinaryTarget('b.bin').mmapWrite(16) as mm:
+                raise RuntimeError()
+        assert not Path('b.bin').exists()
+        with BinaryTarget('c.bin').mmapWrite(0) as mm:
+            pass
+        with BinaryTarget('c.bin').mmapRead() as mm:
+            assert len(mm) == 0
+
+def test_binaryMmapNoSpace(monkeypatch):
+    with TestFieldForFile() as _:
+        def fallocate(fd, offset, size):
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        monkeypatch.setattr(os, 'posix_fallocate', fallocate)
+        with pytest.raises(OSError) as info:
+            with BinaryTarget('a.bin').mmapWrite(1<<20) as mm:
+                pass
+        assert info.value.errno == errno.ENOSPC
+        assert not Path('a.bin').exists()
+
+        def fallocate(fd, offset, size):
+            raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+        monkeypatch.setattr(os, 'posix_fallocate', fallocate)
+        with BinaryTarget('b.bin').mmapWrite(16) as mm:
+            mm[0:4] = b'head'
+        assert Path('b.bin').read_bytes()[0:4] == b'head'
+
+def isTrashGone():
+    return not any(p.name.startswith(PREFIX_TRASH) for p in Path('.').iterdir()) and not any(getTrashRecordDir().iterdir())
+
+def test_overwriteDirInBackground(monkeypatch):
+    with TestFieldForFile() as _:
+        tgt = Target('d')
+        for n in (3, 5):
+            with tgt.pathWrite() as pathTmp:
+                Path(pathTmp).mkdir()
+                for i in range(n):
+                    Path(pathTmp, str(i)).write_text(str(n))
+        # The new one is in place right away
+        assert sorted(os.listdir('d')) == [str(i) for i in range(5)]
+        for _ in range(100):
+            if isTrashGone(): break
+            time.sleep(0.05)
+        assert isTrashGone()
+
+        # Left over by a crash
+        pathTrash, _ = moveToTrash('d')
+        assert cleanTrash() == 1
+        for _ in range(100):
+            if isTrashGone(): break
+            time.sleep(0.05)
+        assert isTrashGone() and not pathTrash.exists()
+
+        # The old one is put back if the new one can't be moved in
+        Path('e').mkdir()
+        Path('e/old').write_text('old')
+        def move(*args, **kwargs):
+            raise OSError(errno.EIO, os.strerror(errno.EIO))
+        monkeypatch.setattr(Target.fs, 'move', move)
+        with pytest.raises(OSError):
+            with Target('e').pathWrite() as pathTmp:
+                Path(pathTmp).mkdir()
+        assert Path('e/old').read_text() == 'old'
+        assert isTrashGone()
@@ -14,14 +14,23 @@
 # limitations under the License.
 
 import os
+import time
+import json
+from collections import Counter
 from datetime import timedelta
 from pathlib import Path
 
+import pytest
 from pytest import fixture
+from plumbum import local
 from .common import TestFieldForFile
 
-from Eikthyr.task import Task
-from Eikthyr.param import PathParameter, TaskParameter
+from Eikthyr.task import BaseTask, Task, getAllInputTargets, resolver
+from Eikthyr.param import PathParameter, TaskParameter, TaskListParameter
+from Eikthyr.specialtask import InputTask
+from Eikthyr.target import statCache
+from Eikthyr.run import run, getParallelismReport
+from Eikthyr import buildstate, trace, outputcache
 
 # Put all luigi imports after Eikthyr to suppress annoying warnings
 import luigi as lg
@@ -100,3 +109,297 @@ def test_canTaskReRunMtime2():
         lg.build([tA, tB, tC,], local_scheduler=True, log_level='WARNING', workers=1)
 
         assert aSideEffects == ['TaskA.run', 'TaskB.run', 'TaskC.run', 'TaskB.run', 'TaskC.run']
+
+aRequiresCalls = []
+
+class TaskDiamond(Task):
+    srcs = TaskListParameter()
+    out = PathParameter()
+
+    def requires(self):
+        aRequiresCalls.append(self.out)
+        return self.srcs
+
+    def run(self):
+        aSideEffects.append(str(self.out))
+        with self.output().fpWrite() as fpw:
+            fpw.write(str(self.out))
+
+def getDiamondLadder(n):
+    tLast = TaskA('a.txt')
+    for i in range(n):
+        tL = TaskDiamond([tLast], 'l{}.txt'.format(i))
+        tR = TaskDiamond([tLast], 'r{}.txt'.format(i))
+        tLast = TaskDiamond([tL, tR], 'm{}.txt'.format(i))
+    return tLast
+
+def test_allInputTargetsDiamond():
+    with TestFieldForFile() as _:
+        tLast = getDiamondLadder(8)
+        aRequiresCalls.clear()
+        aInputs = getAllInputTargets([tLast])
+        assert len(set(t.path for t in aInputs)) == 1 + 3*8 - 1
+        # Each task is visited only once even though there are 2^8 paths
+        assert len(set(aRequiresCalls)) == 3*8
+        assert max(Counter(aRequiresCalls).values()) <= 2
+
+def test_runResolvesOncePerBuild():
+    aSideEffects.clear()
+    with TestFieldForFile() as _:
+        tLast = getDiamondLadder(5)
+        aRequiresCalls.clear()
+        run(tLast)
+        assert Path('m4.txt').read_text() == 'm4.txt'
+        assert len(set(aRequiresCalls)) == 3*5
+        assert max(Counter(aRequiresCalls).values()) <= 2
+        assert resolver.cacheNode.hits > 0
+        # Nothing is remembered outside a build
+        assert len(resolver.cacheNode.data) == 0
+
+def test_inputTaskPrefetch():
+    with TestFieldForFile() as _:
+        Path('in.txt').write_text("Hello")
+        tIn = InputTask('in.txt')
+        tB = TaskB(tIn, 'b.txt')
+        assert tIn.output().path == 'in.txt'
+        run(tB)
+        assert Path('b.txt').read_text() == "Hello, "
+        # Nothing to run: both files were known before luigi started to check the tasks
+        run(tB)
+        assert statCache.misses == 2
+
+def test_digestIgnoresTouch():
+    aSideEffects.clear()
+    with TestFieldForFile() as _:
+        tA, tB, tC = getStdTaskChain()
+        run(tC, check_digest=True)
+        # Make the input look newer without changing its content
+        mtime = os.stat('c.txt').st_mtime + 10
+        os.utime('a.txt', (mtime, mtime))
+        run(tC, check_digest=True)
+        assert aSideEffects == ['TaskA.run', 'TaskB.run', 'TaskC.run']
+
+def test_digestDetectsOldChange():
+    aSideEffects.clear()
+    with TestFieldForFile() as _:
+        tA, tB, tC = getStdTaskChain()
+        run(tC, check_digest=True)
+        # Change the content but make it look older, as rsync may do
+        mtime = os.stat('a.txt').st_mtime - 100
+        Path('a.txt').write_text("Howdy")
+        os.utime('a.txt', (mtime, mtime))
+        run(tC, check_digest=True)
+        assert aSideEffects == ['TaskA.run', 'TaskB.run', 'TaskC.run', 'TaskB.run', 'TaskC.run']
+        assert Path('c.txt').read_text() == "Howdy, World!"
+
+def test_buildStateSkipsWalk():
+    with TestFieldForFile() as _:
+        tLast = getDiamondLadder(3)
+        run(tLast, build_state=True)
+        aRequiresCalls.clear()
+        run(tLast, build_state=True)
+        assert aRequiresCalls == []
+        assert buildstate.isComplete(tLast) == False # Only in use within run()
+
+        # A changed file is noticed, even deep in the graph
+        time.sleep(0.01)
+        Path('l0.txt').write_text('Changed')
+        aSideEffects.clear()
+        run(tLast, build_state=True)
+        assert sorted(aSideEffects) == ['l1.txt', 'l2.txt', 'm0.txt', 'm1.txt', 'm2.txt', 'r1.txt', 'r2.txt']
+
+        assert buildstate.invalidate('TaskDiamond*') == 3*3
+        assert [taskId for taskId, _ in buildstate.getRecords()] == [TaskA('a.txt').task_id]
+
+def test_reprCached():
+    with TestFieldForFile() as _:
+        tA, tB, tC = getStdTaskChain()
+        tD = TaskDiamond([tA, tB], 'd.txt')
+        assert repr(tC) == 'TaskC(src=b.txt, out=c.txt)'
+        assert repr(tD) == 'TaskDiamond(srcs=a.txt;b.txt, out=d.txt)'
+        tB.output = None # Would break if the outputs were looked up again
+        try:
+            assert repr(tC) == 'TaskC(src=b.txt, out=c.txt)'
+            assert repr(TaskDiamond([tB], 'e.txt')) == 'TaskDiamond(srcs=b.txt, out=e.txt)'
+        finally:
+            del tB.output
+
+class TaskSleep(Task):
+    out = PathParameter()
+    tokens = {'disk-io': 1}
+
+    def run(self):
+        time.sleep(0.3)
+        with self.output().fpWrite() as fpw:
+            fpw.write("")
+
+class TaskSleepFree(TaskSleep):
+    tokens = {}
+
+def isOverlapping(aTimeline):
+    (_, tStart1, tEnd1), (_, tStart2, tEnd2) = sorted(aTimeline, key=lambda x: x[1])
+    return tStart2 < tEnd1
+
+def test_runTokens():
+    with TestFieldForFile() as _:
+        rtn = run([TaskSleep('a.txt'), TaskSleep('b.txt')], workers=2)
+        assert not isOverlapping(rtn.worker.aTimeline)
+        rtn = run([TaskSleep('c.txt'), TaskSleep('d.txt')], workers=2, resources={'disk-io': 2})
+        assert isOverlapping(rtn.worker.aTimeline)
+        rtn = run([TaskSleepFree('e.txt'), TaskSleepFree('f.txt')], workers=2, resources={'cores': 1})
+        assert not isOverlapping(rtn.worker.aTimeline)
+
+class TaskEcho(Task):
+    out = PathParameter()
+    code = lg.IntParameter(0)
+
+    def run(self):
+        self.ex(local['sh']['-c', 'echo Hello; exit {}'.format(self.code)])
+        with self.output().fpWrite() as fpw:
+            fpw.write("")
+
+def test_runLogDir():
+    with TestFieldForFile() as _:
+        t = TaskEcho('a.txt')
+        run(t, log_dir='logs')
+        assert Path('logs', t.task_id + '.log').read_text() == 'Hello\n'
+        with pytest.raises(RuntimeError):
+            run(TaskEcho('b.txt', 1), log_dir='logs')
+        assert BaseTask.logDir is None
+
+def test_runTrace():
+    with TestFieldForFile() as _:
+        t = TaskEcho('a.txt')
+        run(t, trace='trace.json', workers=2)
+        aEvents = json.loads(Path('trace.json').read_text())['traceEvents']
+        assert {e['cat'] for e in aEvents} >= {'complete', 'requires', 'run', 'command'}
+        assert all(e['ph'] == 'X' and e['dur'] >= 0 for e in aEvents)
+        aCmds = [e['args']['cmd'] for e in aEvents if e['cat'] == 'command']
+        assert len(aCmds) == 1 and 'echo Hello' in aCmds[0]
+        summary = json.loads(Path('trace.summary.json').read_text())
+        assert summary['tasks'][repr(t)]['run'] > 0
+        assert not trace.enabled
+
+class TaskBigThenSmall(Task):
+    out = PathParameter()
+
+    def run(self):
+        self.ex(local['python3']['-c', 'b = bytearray(100<<20)'])
+        self.ex(local['true'])
+        with self.output().fpWrite() as fpw:
+            fpw.write("")
+
+def test_runTraceMaxrss():
+    with TestFieldForFile() as _:
+        run(TaskBigThenSmall('a.txt'), trace='trace.json')
+        aEvents = [e for e in json.loads(Path('trace.json').read_text())['traceEvents'] if e['cat'] == 'command']
+        # Each command only counts its own memory, not the largest of the ones before it
+        assert [e['args']['returncode'] for e in aEvents] == [0, 0]
+        assert aEvents[0]['args']['maxrss'] > 100<<10 > aEvents[1]['args']['maxrss'] > 0
+        with pytest.raises(RuntimeError):
+            run(TaskEcho('b.txt', 1), trace='trace.json')
+        assert not Path('b.txt').exists()
+
+class TaskEchoMany(Task):
+    out = PathParameter()
+    code = lg.IntParameter(0)
+
+    def run(self):
+        self.exMany([local['sh']['-c', 'i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done'],
+                local['echo']['Hello'] | local['cat'],
+                local['sh']['-c', 'exit {}'.format(self.code)]])
+        with self.output().fpWrite() as fpw:
+            fpw.write("")
+
+class TaskPoolJobs(Task):
+    out = PathParameter()
+    cores = 3
+
+    def run(self):
+        with self.exPool() as pool:
+            pool.add(local['true'])
+        with self.output().fpWrite() as fpw:
+            fpw.write(str(pool.jobs))
+
+def test_exPoolJobs():
+    with TestFieldForFile() as _:
+        run(TaskPoolJobs('a.txt'), resources={'cores': 4})
+        assert Path('a.txt').read_text() == '3'
+
+def test_runTraceCmdPool():
+    with TestFieldForFile() as _:
+        t = TaskEchoMany('a.txt')
+        run(t, trace='trace.json')
+        aEvents = [e for e in json.loads(Path('trace.json').read_text())['traceEvents'] if e['cat'] == 'command']
+        assert len(aEvents) == 3
+        assert all(e['args']['task'] == repr(t) and e['args']['maxrss'] > 0 for e in aEvents)
+        assert max(e['args']['utime'] + e['args']['stime'] for e in aEvents) > 0
+        summary = json.loads(Path('trace.summary.json').read_text())
+        assert summary['tasks'][repr(t)]['command'] > 0
+        with pytest.raises(RuntimeError):
+            run(TaskEchoMany('b.txt', 3), trace='trace.json')
+        assert not Path('b.txt').exists()
+
+def test_parallelismReport():
+    # a -> c, b -> c, where a takes the longest
+    tA, tB, tC = TaskSleep('a.txt'), TaskSleepFree('b.txt'), TaskSleepFree('c.txt')
+    mDeps = {tA: (), tB: (), tC: (tA, tB)}
+    aTimeline = [(tA, 0.0, 3.0), (tB, 0.0, 1.0), (tC, 3.0, 4.0)]
+    report = getParallelismReport(aTimeline, mDeps.__getitem__, 2, [1, 2])
+    assert [t for t, _ in report['criticalPath']] == [tA, tC]
+    assert report['criticalTime'] == 4.0
+    assert report['parallelismPeak'] == 2
+    assert report['parallelismAvg'] == 5.0 / 4.0
+    assert report['idle'] == 3.0
+    assert report['makespan'] == {1: 5.0, 2: 4.0}
+
+@pytest.mark.parametrize('executor,workers', [('local', 1), ('local', 2), ('threads', 2)])
+def test_runLocalExecutor(executor, workers):
+    aSideEffects.clear()
+    with TestFieldForFile() as _:
+        tA, tB, tC = getStdTaskChain()
+        run(tC, executor=executor, workers=workers)
+        assert Path('c.txt').read_text() == 'Hello, World!'
+        if executor == 'threads':
+            assert aSideEffects == ['TaskA.run', 'TaskB.run', 'TaskC.run']
+        rtn = run(tC, executor=executor, workers=workers)
+        assert rtn.worker.aTimeline == []
+        with pytest.raises(RuntimeError):
+            run(TaskEcho('d.txt', 1), executor=executor, workers=workers)
+        assert not Path('d.txt').exists()
+
+def test_runLocalExecutorTokens():
+    with TestFieldForFile() as _:
+        rtn = run([TaskSleep('a.txt'), TaskSleep('b.txt')], workers=2, executor='threads')
+        assert not isOverlapping(rtn.worker.aTimeline)
+        rtn = run([TaskSleepFree('c.txt'), TaskSleepFree('d.txt')], workers=2, executor='threads')
+        assert isOverlapping(rtn.worker.aTimeline)
+
+@pytest.mark.parametrize('executor,workers', [('luigi', 1), ('luigi', 2), ('local', 2)])
+def test_runOutputCache(executor, workers):
+    with TestFieldForFile() as _:
+        for d in ('w1', 'w2'):
+            Path(d).mkdir()
+            with local.cwd(d):
+                aSideEffects.clear()
+                tA, tB, tC = getStdTaskChain()
+                run(tC, output_cache='../cache', workers=workers, executor=executor)
+            assert Path(d, 'c.txt').read_text() == 'Hello, World!'
+            assert outputcache.stats[:] == ([3, 0, 0] if d == 'w2' else [0, 3, 3])
+            if workers == 1:
+                assert aSideEffects == ([] if d == 'w2' else ['TaskA.run', 'TaskB.run', 'TaskC.run'])
+        assert len(list(Path('cache').glob('*/*/meta.json'))) == 3
+
+        # Restored outputs don't share anything with the cache
+        assert Path('w2', 'c.txt').stat().st_nlink == 1
+        with open(Path('w2', 'c.txt'), 'a') as fpw:
+            fpw.write('!')
+        assert all(p.read_text() != 'Hello, World!!' for p in Path('cache').glob('*/*/0'))
+
+        # Only the newest one fits
+        Path('w3').mkdir()
+        with local.cwd('w3'):
+            Path('a.txt').write_text('Hi')
+            run(TaskB(InputTask('a.txt'), 'b.txt'), output_cache='../cache', output_cache_size=5)
+        aEntries = list(Path('cache').glob('*/*/meta.json'))
+        assert len(aEntries) == 1 and 'a.txt' in aEntries[0].read_text()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2023, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import threading
+from pathlib import Path
+
+import pytest
+from .common import TestFieldForFile
+
+from Eikthyr.task import Task
+from Eikthyr.param import PathParameter, TaskParameter
+from Eikthyr.specialtask import InputTask
+from Eikthyr.watch import watch, TaskGraph
+
+# Put all luigi imports after Eikthyr to suppress annoying warnings
+import luigi as lg
+
+aRuns = []
+
+class TaskCopy(Task):
+    src = TaskParameter()
+    out = PathParameter()
+
+    def run(self):
+        aRuns.append(str(self.out))
+        with self.input().open('r') as fp:
+            buf = fp.read()
+        with self.output().fpWrite() as fpw:
+            fpw.write(buf)
+
+class TaskCopySlow(TaskCopy):
+    def run(self):
+        super().run()
+        time.sleep(1.0)
+
+aRequires = []
+
+class TaskCopyCounted(TaskCopy):
+    def requires(self):
+        aRequires.append(str(self.out))
+        return super().requires()
+
+class TaskList(Task):
+    src = TaskParameter()
+    out = PathParameter()
+
+    def run(self):
+        aRuns.append(str(self.out))
+        with self.output().fpWrite() as fpw:
+            for d, _, aFiles in sorted(os.walk(self.input().path)):
+                for f in sorted(aFiles):
+                    fpw.write('{} {}\n'.format(os.path.join(d, f), Path(d, f).read_text()))
+
+def waitFor(fnCheck, timeout=10.0):
+    tEnd = time.time() + timeout
+    while not fnCheck():
+        assert time.time() < tEnd
+        time.sleep(0.05)
+
+def test_graphAffected():
+    with TestFieldForFile() as _:
+        tA, tB = InputTask('a.txt'), InputTask('b.txt')
+        tA1, tB1 = TaskCopy(tA, 'a1.txt'), TaskCopy(tB, 'b1.txt')
+        tA2 = TaskCopy(tA1, 'a2.txt')
+        graph = TaskGraph([tA2, tB1])
+        assert sorted(graph.mPathTasks) == [os.path.abspath('a.txt'), os.path.abspath('b.txt')]
+        assert graph.getAffectedTasks({os.path.abspath('a.txt')}) == [tA2]
+        assert graph.getAffectedTasks({os.path.abspath('c.txt')}) == []
+
+@pytest.mark.parametrize('polling', [False, True])
+def test_watch(polling):
+    aRuns.clear()
+    with TestFieldForFile() as _:
+        Path('a.txt').write_text('1')
+        Path('b.txt').write_text('1')
+        tA1, tB1 = TaskCopy(InputTask('a.txt'), 'a1.txt'), TaskCopy(InputTask('b.txt'), 'b1.txt')
+        thread = threading.Thread(target=watch, args=([tA1, tB1],),
+                kwargs={'debounce': 0.3, 'interval': 0.1, 'polling': polling, 'rounds': 1, 'executor': 'local'})
+        thread.start()
+        waitFor(lambda: Path('b1.txt').exists())
+        time.sleep(0.5)
+        aRuns.clear()
+        Path('a.txt').write_text('2')
+        thread.join(10)
+        assert not thread.is_alive()
+        assert Path('a1.txt').read_text() == '2'
+        assert aRuns == ['a1.txt']
+
+def test_watchKeepsGraph():
+    aRuns.clear()
+    with TestFieldForFile() as _:
+        Path('a.txt').write_text('1')
+        Path('d/sub').mkdir(parents=True)
+        Path('d/sub/x.txt').write_text('1')
+        tB = TaskCopyCounted(InputTask('a.txt'), 'b.txt')
+        tD = TaskList(InputTask('d'), 'd.txt')
+        thread = threading.Thread(target=watch, args=([tB, tD],),
+                kwargs={'debounce': 0.3, 'rounds': 1, 'executor': 'local'})
+        thread.start()
+        waitFor(lambda: Path('b.txt').exists() and Path('d.txt').exists())
+        time.sleep(0.5)
+        aRuns.clear()
+        aRequires.clear()
+        # Deep inside a directory source
+        Path('d/sub/x.txt').write_text('2')
+        thread.join(10)
+        assert not thread.is_alive()
+        assert aRuns == ['d.txt']
+        assert 'd/sub/x.txt 2' in Path('d.txt').read_text()
+        assert aRequires == []
+
+def test_watchChangeDuringBuild():
+    aRuns.clear()
+    with TestFieldForFile() as _:
+        Path('a.txt').write_text('1')
+        Path('b.txt').write_text('1')
+        tA1, tB1 = TaskCopySlow(InputTask('a.txt'), 'a1.txt'), TaskCopy(InputTask('b.txt'), 'b1.txt')
+        thread = threading.Thread(target=watch, args=([tA1, tB1],),
+                kwargs={'debounce': 0.3, 'rounds': 2, 'executor': 'local'})
+        thread.start()
+        waitFor(lambda: Path('a1.txt').exists() and Path('b1.txt').exists())
+        time.sleep(1.5)
+        aRuns.clear()
+        Path('a.txt').write_text('2')
+        waitFor(lambda: aRuns == ['a1.txt'])
+        # Edited while a1.txt is still being built, and never touched again
+        Path('b.txt').write_text('2')
+        thread.join(10)
+        assert not thread.is_alive()
+        assert Path('a1.txt').read_text() == '2'
+        assert Path('b1.txt').read_text() == '2'
+        assert aRuns == ['a1.txt', 'b1.txt']